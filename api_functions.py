@@ -1,25 +1,50 @@
 import json
-from flask import Flask, jsonify, request
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, request
 
-from ball_tracking import Tracker
+from instrumentation import Metrics
+from sessions import SessionRegistry, make_session_tracker
+from jobs import JobQueue
+import cv2
 import numpy as np
-from PIL import Image
 
 
 app = Flask(__name__)
 
-tracker = Tracker(focal_length_px=2000, image_size=(4000, 3000), table_points=None)
+metrics = Metrics()  # shared by every session's tracker, served at /metrics
 
+sessions = SessionRegistry(lambda: make_session_tracker(metrics), max_sessions=64, ttl=600)  # every client/table gets its own tracker
+
+jobs = None  # made on first use, so importing this doesn't start worker processes
+jobs_lock = threading.Lock()  # so two first requests on the threaded server don't both make one
+
+decode_pool = ThreadPoolExecutor(max_workers=8)  # cv2.imdecode lets go of the GIL so batches decode in parallel
+
+
+def get_session():
+    '''the session this request is for, from the X-Session-ID header or a session_id field. requests without one share "default"'''
+    session_id = request.headers.get("X-Session-ID") or request.values.get("session_id")
+    if session_id is None and request.is_json:
+        session_id = (request.get_json(silent=True) or {}).get("session_id")
+    return sessions.get(session_id or "default")
 
 @app.post("/set_corners")
 def update_corners():
     data = request.get_json()
     corners = data['corners']  # put these in order
-    tracker.set_table_points(corners)
+    session = get_session()
+    with session.lock:
+        session.tracker.set_table_points(corners)
     
 @app.post("/output_positions")
 def output_position_data():
-    return {"bounces" : tracker.bounce_positions, "hits" : tracker.hit_positions, "net_hits" : tracker.net_hit_positions} # each of these will probably be x_pos, y_pos, and speed
+    session = get_session()
+    with session.lock:
+        tracker = session.tracker
+        return {"bounces" : tracker.bounce_positions, "hits" : tracker.hit_positions, "net_hits" : tracker.net_hit_positions} # each of these will probably be x_pos, y_pos, and speed
 
 @app.post("/output_stats")
 def calc_stats():
@@ -32,10 +57,147 @@ def process_tracking():
     if not file:
         return {"error": "No image provided"}, 400
 
-    img = Image.open(file.stream).convert("RGB")
-    img_np = np.array(img)
+    frame = decode_image(file.read())  # BGR like /process_batch, the session's tracker diffs both
+    if frame is None:
+        return {"error": "Could not decode the image"}, 400
+
+    session = get_session()
+    with session.lock:
+        tracker = session.tracker
+        detection, score = tracker.track(frame)
+        found = not detection is None and score > tracker.confidence_threshold
+        return {"detection" : [float(v) for v in detection[0]] if found else None, "score" : float(score), "events" : tracker.new_events}
+    
+@app.post("/process_raw")
+def process_raw():
+    '''one raw "nv12" or "i420" frame as the whole request body, with its width, height and format as query parameters.
+    the body gets wrapped without copying and the tracker diffs its chroma, so there's no image decode or colour conversion'''
+    width = request.args.get("width", type=int)
+    height = request.args.get("height", type=int)
+    pixel_format = request.args.get("format", "nv12")
+    if width is None or height is None or width % 2 or height % 2 or not pixel_format in ("nv12", "i420"):
+        return {"error": "Needs an even width and height and a format of nv12 or i420"}, 400
+    data = request.get_data()
+    if len(data) != width * height * 3 // 2:
+        return {"error": "Expected " + str(width * height * 3 // 2) + " bytes"}, 400
+    frame = np.frombuffer(data, dtype=np.uint8).reshape(height * 3 // 2, width)
+
+    session = get_session()
+    with session.lock:
+        tracker = session.tracker
+        if tracker.input_format != pixel_format:
+            if not tracker.prev_frame is None:
+                return {"error": "This session is getting " + tracker.input_format + " frames"}, 409
+            tracker.input_format = pixel_format  # first frame of the session decides
+        detection, score = tracker.track(frame, calc_position=False)
+        found = not detection is None and score > tracker.confidence_threshold
+        return {"detection" : [float(v) for v in detection[0]] if found else None, "score" : float(score), "events" : tracker.new_events}
+
+def decode_image(data):
+    '''encoded image bytes to a BGR frame like cv2.VideoCapture gives, None if it can't be decoded'''
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def decode_video(file):
+    '''all frames of an uploaded video segment, cv2 can only open videos from disk'''
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as tmp:
+        file.save(tmp.name)
+        cap = cv2.VideoCapture(tmp.name)
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    return frames
+
+@app.post("/process_batch")
+def process_batch():
+    '''tracks a batch of frames in one request, either several "frames" image files in order or one short "video" file.
+    returns the detections and events from this batch'''
+    video = request.files.get("video")
+    if video:
+        frames = decode_video(video)
+    else:
+        frames = list(decode_pool.map(decode_image, [file.read() for file in request.files.getlist("frames")]))
 
-    tracker.track(img_np)
+    if len(frames) == 0:
+        return {"error": "No frames provided"}, 400
+    if any(frame is None for frame in frames):
+        return {"error": "Could not decode every frame"}, 400
+
+    session = get_session()
+    metrics.add_gauge("frame_queue_depth", len(frames))  # decoded frames waiting to be tracked, over all requests
+    remaining = len(frames)
+    try:
+        with session.lock:
+            tracker = session.tracker
+            if tracker.input_format != "bgr":
+                return {"error": "This session is getting " + tracker.input_format + " frames"}, 409
+            first_frame = tracker.frame_index
+            events = []
+            for frame in frames:
+                tracker.track(frame, calc_position=False)
+                events.extend(tracker.new_events)
+                remaining -= 1
+                metrics.add_gauge("frame_queue_depth", -1)
+
+            trajectory = tracker.trajectory
+            new = trajectory.frame_numbers >= first_frame
+            detections = [{"frame_number" : int(frame_number), "screen_pos" : position2d.tolist(), "table_pos" : table_position.tolist()}
+                          for frame_number, position2d, table_position
+                          in zip(trajectory.frame_numbers[new], trajectory.positions2d[new], trajectory.table_positions[new])]
+    finally:
+        metrics.add_gauge("frame_queue_depth", -remaining)  # whatever a 409 or an error left untracked
+    # nan (no table points yet) isn't valid json
+    for detection in detections:
+        if np.isnan(detection["table_pos"]).any():
+            detection["table_pos"] = None
+
+    return {"session_id" : session.session_id, "frames" : len(frames), "detections" : detections, "events" : events}
+    
+def get_jobs():
+    global jobs
+    with jobs_lock:
+        if jobs is None:
+            jobs = JobQueue(db_path="jobs.sqlite", max_workers=2)
+    return jobs
+
+@app.post("/jobs")
+def submit_job():
+    '''queues a whole "video" file for processing with its table "corners" (a json list of 4 [x, y] in order), returns the job id to poll'''
+    video = request.files.get("video")
+    corners = request.form.get("corners")
+    if not video or not corners:
+        return {"error": "Needs a video and its corners"}, 400
+
+    fd, video_path = tempfile.mkstemp(suffix=os.path.splitext(video.filename or "")[1] or ".mp4")
+    with os.fdopen(fd, "wb") as video_file:
+        video.save(video_file)
+    job_id = get_jobs().submit(video_path, json.loads(corners), delete_video=True)
+    return {"job_id": job_id}, 202
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    status = get_jobs().status(job_id)
+    if status is None:
+        return {"error": "Unknown job"}, 404
+    return status
+
+@app.get("/jobs/<job_id>/result")
+def job_result(job_id):
+    status = get_jobs().status(job_id)
+    if status is None:
+        return {"error": "Unknown job"}, 404
+    if status["state"] != "done":
+        return {"error": "Job is " + status["state"]}, 409
+    return {"events": get_jobs().result(job_id)}
+
+@app.post("/jobs/<job_id>/cancel")
+def cancel_job(job_id):
+    if not get_jobs().cancel(job_id):
+        return {"error": "Job isn't queued or running"}, 409
+    return get_jobs().status(job_id)
     
 @app.post("/process_image")   
 def corner_points_to_dict(self, corner_points):
@@ -50,6 +212,12 @@ def corner_points_to_dict(self, corner_points):
     return {"TL": top_left, "TR": top_right, "BR": bottom_left, "BL": bottom_right}
 
 
+@app.get("/metrics")
+def get_metrics():
+    '''stage timings, contour counts, detections and queue depth of every session, in the prometheus text format'''
+    metrics.set_gauge("sessions", len(sessions))
+    return Response(metrics.prometheus_text(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/hello")
 def hello():
     return {"message": "hello Pierre"}
\ No newline at end of file
@@ -2,55 +2,134 @@ import cv2
 import numpy as np
 from matplotlib import pyplot as plt
 import math
-from geometry_utils import trilaterate_2d_4points, multilateration_4pts, get_homography, get_ground_point_full
-from bounce_detection import find_robust_peaks
-from scipy.ndimage import median_filter, rotate
+from geometry_utils import trilaterate_2d_4points, multilateration_4pts, get_homography, get_ground_point_full, transform_points, TableGeometry
+from scipy.ndimage import rotate
+from trajectory_store import TrajectoryStore
+from smoothing import smooth_by_distance, StreamingSmoother
+from event_detection import find_events, OnlineEventDetector
+import instrumentation
+from preprocessors import make_preprocessor
 
 
 FEET_PER_METER = 3.28084
 MM_PER_FT = 304.8
+TABLE_LENGTH_MM = 2740
+TABLE_WIDTH_MM = 1525
+MAX_BALL_SPEED = 35000  # mm/s, a bit over the fastest smashes, anything quicker is a bad table position
 
 def simple_moving_average(data, window_size):
     weights = np.ones(window_size) / window_size
     sma = np.convolve(data, weights, mode='valid')
     return sma
 
-def smooth_by_distance(frame_numbers, readings, sigma=5):
-    frame_numbers = np.array(frame_numbers)
-    readings = np.array(readings)
-    
-    full_frames = np.arange(frame_numbers.min(), frame_numbers.max() + 1)
-    smoothed = np.zeros(len(full_frames))
-
-    for j, f in enumerate(full_frames):
-        d = np.abs(frame_numbers - f)
-        weights = np.exp(-(d**2) / (2 * sigma**2))
-        smoothed[j] = np.sum(weights * readings) / np.sum(weights)
-
-    return full_frames, smoothed
-
 class Tracker:
-    def __init__(self, focal_length_px, image_size, table_points=None, confidence_threshold=0.8):
+    def __init__(self, focal_length_px, image_size, table_points=None, confidence_threshold=0.8,
+                 use_roi=False, roi_margin=120, roi_max_misses=2, roi_refresh_interval=10,
+                 use_size_map=True, size_map_tile=16, min_size_factor=1.0, max_size_factor=30.0,
+                 detection_scale=1.0, refine_margin=10, max_history=None, live_smoothing_sigma=None,
+                 online_events=False, event_lag=15, framerate=120, input_format="bgr", size_method="rotate",
+                 metrics=None, motion_gate=False, gate_scale=0.125, gate_threshold=25, gate_hold=15,
+                 use_table_mask=False, mask_margin=0.05, mask_height=0.6, preprocessor="two_frame"):
+        if not input_format in ("bgr", "nv12", "i420"):
+            raise ValueError("input_format has to be bgr, nv12 or i420")
+        if input_format != "bgr" and detection_scale < 1:
+            raise ValueError("detection_scale only works with bgr frames, raw yuv chroma is already half resolution")
+        if not size_method in ("rotate", "warp", "moments"):
+            raise ValueError("size_method has to be rotate, warp or moments")
         self.confidence_threshold = confidence_threshold
         self.focal_length_px = focal_length_px
         self.table_points = table_points #Now a dictionary
         if not self.table_points is None:
-            self.H = get_homography(self.dictionary_to_arranged_list(self.table_points))
+            self.set_homography()
         self.image_size = image_size
+        self.framerate = framerate  # of the footage, for velocities
         self.prev_frame = None
         self.true_ball_diameter = 0.04 # this is in meters
         
         self.frame_index = 0
-        self.recorded_sizes = []        # this really should be an object and not a bunch of lists
-        self.recorded_distances = []    # but I tried refactoring it and got bored so oh well
-        self.frame_numbers = []
-        self.recorded_angles = []
-        self.recorded_positions = []
-        self.recorded_positions2d = []
-        self.recorded_table_positions = []
-        self.recorded_detections = []
+        self.trajectory = TrajectoryStore(max_length=max_history)  # one row per detection, max_history keeps only the newest ones
+        # smooths sizes and distances as frames go by, last_smoothed is (frames, [[size, distance], ...]) that just became final on this frame
+        self.live_smoother = None if live_smoothing_sigma is None else StreamingSmoother(live_smoothing_sigma)
+        self.last_smoothed = None
+        # detects hits/bounces/nets while tracking, new_events has whatever the last frame decided.
+        # event_lag is in frames, every event comes out event_lag frames after the frame it happened on
+        self.event_detector = OnlineEventDetector(self.is_net_hit, lag=event_lag) if online_events else None
+        self.new_events = []
         self.last_processed_frame = None
         
+        self.use_roi = use_roi                  # only diff and search a window around where the ball should be
+        self.roi_margin = roi_margin            # extra pixels around the predicted window on every side
+        self.roi_max_misses = roi_max_misses    # misses in a row before going back to the full frame
+        self.roi_refresh_interval = roi_refresh_interval  # full frame search every so often so the window can't get stuck on a player
+        self.roi_misses = 0
+        self.last_window = None
+        
+        self.use_size_map = use_size_map        # drop contours that can't be a ball before fitting, needs table points
+        self.size_map_tile = size_map_tile
+        self.min_size_factor = min_size_factor  # allowed contour size relative to the expected ball size, the upper one is
+        self.max_size_factor = max_size_factor  # big because the diff has the ball twice plus motion blur
+        self.size_map = None
+        
+        self.detection_scale = detection_scale  # < 1 finds the ball on a downscaled frame first, then refines it at full resolution
+        self.refine_margin = refine_margin      # full resolution pixels around the coarse ellipse to refine in
+        self.prev_frame_small = None
+        self.frame_small = None
+        
+        # "bgr" for frames like cv2 gives them, "nv12" or "i420" for raw yuv buffers shaped (height * 3 / 2, width),
+        # which skip the Lab conversion since the diff is taken on their chroma planes directly
+        self.input_format = input_format
+        
+        # how count_pixels measures the ball. "rotate" is the original scipy spline rotation, "warp" does the
+        # same rotation with cv2.warpAffine and "moments" skips resampling and uses the diff's second moments
+        self.size_method = size_method
+        
+        # an instrumentation.Metrics that gets the time of every stage, contour counts and detection counts,
+        # the default one is switched off and costs next to nothing
+        self.metrics = instrumentation.DISABLED if metrics is None else metrics
+        
+        # skips the diff and ellipse search on frames where nothing moves. every frame gets shrunk by gate_scale
+        # and its chroma compared to the last one, any cell changing by more than gate_threshold (squared distance
+        # like preprocess) counts as motion. after motion every frame is searched for gate_hold more frames
+        self.motion_gate = motion_gate
+        self.gate_scale = gate_scale
+        self.gate_threshold = gate_threshold
+        self.gate_hold = gate_hold
+        self.gate_prev = None
+        self.gate_open_until = -1
+        self.skipped_frames = 0
+        
+        # only diff where the ball can be: the table quad stretched upwards by mask_height times its on screen
+        # width and grown by mask_margin times that width all round, needs table points. players and
+        # spectators outside of it never become contours
+        self.use_table_mask = use_table_mask
+        self.mask_margin = mask_margin
+        self.mask_height = mask_height
+        self.table_masks = {}  # frame shape -> (mask, bounding box), one for the full frame and one per downscaled size
+        self.table_mask_shape = None
+        
+        # what turns a frame into the image the ball gets found in, a name from preprocessors.PREPROCESSORS or a
+        # preprocessors.Preprocessor. the default is the original two frame chroma diff, the backend keeps its own cost.
+        # preprocessor_name is there so the result cache tells backends apart
+        self.preprocessor = make_preprocessor(preprocessor)
+        if detection_scale < 1 and not self.preprocessor.supports_detection_scale:
+            raise ValueError(f"the {self.preprocessor.name} preprocessor doesn't work with detection_scale, it has its own scale option")
+        self.preprocessor_name = self.preprocessor.name
+        self.prev_prev_frame = None  # the frame before prev_frame, for the three frame diff
+        
+    # the old list attributes, now zero copy views into the trajectory store
+    frame_numbers = property(lambda self: self.trajectory.frame_numbers)
+    recorded_sizes = property(lambda self: self.trajectory.sizes)
+    recorded_distances = property(lambda self: self.trajectory.distances)
+    recorded_angles = property(lambda self: self.trajectory.angles)
+    recorded_positions = property(lambda self: self.trajectory.positions)
+    recorded_positions2d = property(lambda self: self.trajectory.positions2d)
+    recorded_table_positions = property(lambda self: self.trajectory.table_positions)
+    
+    @property
+    def recorded_detections(self):
+        '''ellipse tuples for cv2.ellipse and friends, this one gets rebuilt every time so use trajectory.detections in loops'''
+        return [self.trajectory.ellipse(i) for i in range(len(self.trajectory))]
+        
     def set_distances(self):
         self.distances_to_cam = self.calc_corner_distances() # or whatever it needs to be... from a function maybe
         if self.distances_to_cam is not None:
@@ -60,13 +139,107 @@ class Tracker:
                 [pt[0], pt[1], 0.0] for pt in self.corner_locations_mm_2d
             ])
             self.camera_pos = multilateration_4pts(self.corner_locations_3d, self.distances_to_cam_rearranged)[0]
+            self.geometry = TableGeometry(self.corner_locations_mm_2d, self.camera_pos)  # solves calc_position in batches
         
     def set_table_points(self, table_points):
         self.table_points = table_points
+        self.set_homography()
+        self.size_map = None  # gets rebuilt for the new corners on the next frame
+        self.table_mask_shape = None  # same for the table mask
+        
+    def set_homography(self):
+        '''H maps screen pixels to table mm, H_inv the other way. both only change when the table points do'''
         self.H = get_homography(self.dictionary_to_arranged_list(self.table_points))
+        self.H_inv = np.linalg.inv(self.H)
+        
+    def expected_ball_diameter(self, x, y):
+        '''how many pixels wide a ball lying on the table would be at screen position x, y (scalars or arrays).
+        the homography maps pixels to table mm, the determinant of its jacobian there is mm^2 per pixel^2'''
+        w = self.H[2, 0] * x + self.H[2, 1] * y + self.H[2, 2]
+        with np.errstate(divide="ignore"):
+            mm_per_px = np.sqrt(np.abs(np.linalg.det(self.H)) / np.abs(w) ** 3)
+            return self.true_ball_diameter * 1000 / mm_per_px
+        
+    def build_size_map(self, image_shape):
+        '''expected ball diameter in pixels for every size_map_tile x size_map_tile tile of the image.
+        a ball in the air is closer to the camera than the table point behind it, so the map is clamped
+        to the sizes at the table corners instead of shrinking to nothing towards the horizon'''
+        tile = self.size_map_tile
+        xs = (np.arange(-(-image_shape[1] // tile)) + 0.5) * tile
+        ys = (np.arange(-(-image_shape[0] // tile)) + 0.5) * tile
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        
+        corners = self.dictionary_to_arranged_list(self.table_points)
+        corner_sizes = self.expected_ball_diameter(corners[:, 0], corners[:, 1])
+        self.size_map = np.clip(self.expected_ball_diameter(grid_x, grid_y), np.min(corner_sizes), np.max(corner_sizes))
+        self.size_map_shape = image_shape[:2]
+        
+    def build_table_mask(self, image_shape):
+        '''the play volume mask (255 inside) for frames of image_shape, see use_table_mask'''
+        corners = self.dictionary_to_arranged_list(self.table_points).astype(float)
+        table_width = np.ptp(corners[:, 0])
+        lifted = corners - [0, self.mask_height * table_width]
+        hull = cv2.convexHull(np.round(np.vstack((corners, lifted)) * 16).astype(np.int32))
+        
+        mask = np.zeros(image_shape[:2], dtype=np.uint8)
+        cv2.fillConvexPoly(mask, hull, 255, shift=4)
+        margin = int(round(self.mask_margin * table_width))
+        if margin > 0:
+            # a thick line has round ends, so the outline drawn 2 * margin wide grows the hull by margin all round
+            cv2.polylines(mask, [hull], True, 255, 2 * margin + 1, shift=4)
+        
+        x, y, w, h = cv2.boundingRect(mask)
+        self.table_masks = {tuple(image_shape[:2]): (mask, (x, y, x + w, y + h))}
+        self.table_mask_shape = tuple(image_shape[:2])
+        
+    def table_mask(self, image_shape):
+        '''(mask, (x0, y0, x1, y1) bounding box) for frames of image_shape, None without a mask.
+        the downscaled frames of find_ball_pyramid get the full one shrunk'''
+        if not self.use_table_mask or self.table_mask_shape is None:
+            return None
+        image_shape = tuple(image_shape[:2])
+        if not image_shape in self.table_masks:
+            full_mask = self.table_masks[self.table_mask_shape][0]
+            mask = cv2.resize(full_mask, (image_shape[1], image_shape[0]), interpolation=cv2.INTER_NEAREST)
+            x, y, w, h = cv2.boundingRect(mask)
+            self.table_masks[image_shape] = (mask, (x, y, x + w, y + h))
+        return self.table_masks[image_shape]
+        
+    def filter_contours_by_size(self, contours, offset=(0, 0), scale=1.0):
+        '''drops contours whose bounding box is way off the expected ball size at their spot.
+        contours are in pixels of an image that is scale times the frame size and starts at offset (full size pixels)'''
+        if self.size_map is None:
+            return contours
+        tile = self.size_map_tile
+        rows, cols = self.size_map.shape
+        kept = []
+        for cont in contours:
+            if len(cont) < 5:
+                continue  # safe_fit_ellipse would skip it anyway
+            x, y, w, h = cv2.boundingRect(cont)
+            row = int((y + h / 2) / scale + offset[1]) // tile
+            col = int((x + w / 2) / scale + offset[0]) // tile
+            expected = self.size_map[min(row, rows - 1), min(col, cols - 1)] * scale
+            if self.min_size_factor * expected <= max(w, h) <= self.max_size_factor * expected:
+                kept.append(cont)
+        return kept
         
     def calc_table_position(self, screen_position):
         return self.transform_point(self.H, screen_position[0], screen_position[1])
+    
+    def calc_table_positions(self, screen_positions):
+        '''calc_table_position for an (N, 2) array of screen positions at once'''
+        return transform_points(self.H, screen_positions)
+    
+    def calc_screen_positions(self, table_positions):
+        '''the other way around, table mm to screen pixels for an (N, 2) array'''
+        return transform_points(self.H_inv, table_positions)
+    
+    def fill_table_positions(self):
+        '''(re)computes the table position of every recorded detection in one go, for when tracking ran
+        with table_position=False or the table points changed since'''
+        if not self.table_points is None:
+            self.trajectory.table_positions[:] = self.calc_table_positions(self.trajectory.detections[:, :2])
         
     def corner_calibration(self, no_ball, front_ball, back_ball):
         tracker = Tracker(self.focal_length_px, self.image_size, None)
@@ -93,8 +266,9 @@ class Tracker:
         return image
 
         
-    def detect_best_ellipse(self, binary_img, write_image=None):
-        '''outputs resulting_image, best_ellipse, best_score'''
+    def detect_best_ellipse(self, binary_img, write_image=None, offset=(0, 0), scale=1.0):
+        '''outputs resulting_image, best_ellipse, best_score. offset is where binary_img starts in the full frame
+        and scale is how big binary_img is compared to the full frame, the ellipse stays in binary_img coordinates'''
 
         # Normalize input
         if binary_img.dtype != np.uint8:
@@ -102,24 +276,21 @@ class Tracker:
         else:
             img = binary_img.copy()
 
-        contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        with self.metrics.time("find_contours"):
+            contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            self.metrics.observe("contours", len(contours), instrumentation.COUNT_BUCKETS)
+            contours = self.filter_contours_by_size(contours, offset, scale)
 
         best_score = -1
         best_ellipse = None
 
-        for cont in contours:
-            ellipse = self.safe_fit_ellipse(cont)
-            if ellipse is None:
-                continue
-
-            area_score = self.ellipse_area_score(cont, ellipse)      # [0, 1]
-            geom_score = self.ellipse_geometric_score(cont, ellipse) # ~[0, 1]
-
-            final_score = 0.5 * area_score + 0.5 * geom_score
-
-            if final_score > best_score:
-                best_score = final_score
-                best_ellipse = ellipse
+        with self.metrics.time("fit_ellipses"):
+            ellipses, scores = self.score_contours(contours, scale)
+        scores = np.where(np.isnan(scores), -np.inf, scores)  # degenerate ellipses score nan and never win
+        if len(ellipses) > 0 and np.max(scores) > best_score:
+            best = np.argmax(scores)  # first of any ties, same as the old loop
+            best_score = float(scores[best])
+            best_ellipse = ellipses[best]
 
         if not write_image is None:
             result = write_image
@@ -153,6 +324,56 @@ class Tracker:
             return None
 
 
+    def score_contours(self, contours, scale=1.0):
+        '''fits every contour and scores them all at once, returns (ellipses, scores)'''
+        ellipses = []
+        fitted = []
+        for cont in contours:
+            ellipse = self.safe_fit_ellipse(cont)
+            if ellipse is None:
+                continue
+            ellipses.append(ellipse)
+            fitted.append(cont)
+
+        return ellipses, self.score_ellipses(fitted, ellipses, scale)
+
+    def score_ellipses(self, contours, ellipses, scale=1.0):
+        '''same 0.5 * area score + 0.5 * geometric score as ellipse_area_score and ellipse_geometric_score,
+        but for every contour of a frame at once with numpy instead of looping over every point in python.
+        scale is for downscaled frames, it shrinks the minimum major axis to match'''
+        if len(ellipses) == 0:
+            return np.zeros(0)
+        fitted = contours
+
+        cx, cy, ax1, ax2, angle = np.array([[c[0], c[1], ax[0], ax[1], a] for c, ax, a in ellipses]).T
+
+        # area score
+        ellipse_areas = np.pi * (ax1 / 2.0) * (ax2 / 2.0)
+        contour_areas = np.array([cv2.contourArea(cont) for cont in fitted])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            area_scores = np.minimum(contour_areas, ellipse_areas) / np.maximum(contour_areas, ellipse_areas)
+        area_scores[(contour_areas <= 0) | (ellipse_areas <= 0) | (ax2 < 20 * scale)] = 0.0
+
+        # geometric score, the points of every contour get stacked into one array and
+        # owner says which ellipse each point gets compared against
+        lengths = np.array([len(cont) for cont in fitted])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        owner = np.repeat(np.arange(len(fitted)), lengths)
+        points = np.concatenate(fitted).reshape(-1, 2)
+
+        angle_rad = np.deg2rad(angle)
+        cos = np.cos(angle_rad)[owner]
+        sin = np.sin(angle_rad)[owner]
+        vx = points[:, 0] - cx[owner]
+        vy = points[:, 1] - cy[owner]
+        x = cos * vx + sin * vy     # R.T @ v
+        y = -sin * vx + cos * vy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            errors = np.abs((x / (ax1[owner] / 2))**2 + (y / (ax2[owner] / 2))**2 - 1)
+        geom_scores = 1.0 / (1.0 + np.add.reduceat(errors, starts) / lengths)
+
+        return 0.5 * area_scores + 0.5 * geom_scores
+
     def ellipse_area_score(self, cont, ellipse):
         (cx, cy), (ax1, ax2), angle = ellipse
         ellipse_area = np.pi * (ax1 / 2.0) * (ax2 / 2.0)
@@ -187,14 +408,75 @@ class Tracker:
         avg_err = np.mean(errors)
         return 1.0 / (1.0 + avg_err)  # convert to similarity: high = good
     
-    def preprocess(self, frame):
+    def frame_shape(self, frame):
+        '''(height, width) of the image in frame, raw yuv buffers are 1.5 times as tall as their image'''
+        if self.input_format == "bgr":
+            return frame.shape[:2]
+        return frame.shape[0] * 2 // 3, frame.shape[1]
+    
+    def chroma_planes(self, frame):
+        '''the half resolution U and V planes of a raw yuv frame, as views into it'''
+        height, width = self.frame_shape(frame)
+        if self.input_format == "nv12":
+            uv = frame[height:].reshape(height // 2, width // 2, 2)  # one plane with U and V interleaved
+            return uv[:, :, 0], uv[:, :, 1]
+        u, v = frame[height:].reshape(2, height // 2, width // 2)    # i420, the whole U plane then the whole V plane
+        return u, v
+    
+    def preprocess_yuv(self, frame, window, prev_frame):
+        '''preprocess for raw yuv frames, diffs U and V at half resolution and scales the result back up to the window'''
+        height, width = self.frame_shape(frame)
+        x0, y0, x1, y1 = (0, 0, width, height) if window is None else window
+        cx0, cy0, cx1, cy1 = x0 // 2, y0 // 2, -(-x1 // 2), -(-y1 // 2)
+        
+        distances = np.zeros((cy1 - cy0, cx1 - cx0), dtype=np.int32)
+        for plane, prev_plane in zip(self.chroma_planes(frame), self.chroma_planes(prev_frame)):
+            diff = plane[cy0:cy1, cx0:cx1].astype(np.int32) - prev_plane[cy0:cy1, cx0:cx1]
+            distances += diff * diff
+        threshold_arr = np.where(distances > 10, np.minimum(distances, 255), 0).astype(np.uint8)
+        
+        threshold_arr = cv2.resize(threshold_arr, None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST)
+        return threshold_arr[y0 - 2 * cy0:y1 - 2 * cy0, x0 - 2 * cx0:x1 - 2 * cx0]
+    
+    def preprocess(self, frame, window=None, prev_frame=None):
+        '''window is (x0, y0, x1, y1), only that part of the frame gets diffed. prev_frame defaults to self.prev_frame'''
         if self.prev_frame is None:
             raise ("Cannot run preprocessing without a previous frame")
         
+        if prev_frame is None:
+            prev_frame = self.prev_frame
+        table_mask = self.table_mask(self.frame_shape(frame))
+        if table_mask is None:
+            return self.preprocessor(self, frame, window, prev_frame)
+        
+        # only diff the part of the window the mask's bounding box covers, then clear what's outside the mask
+        mask, (mx0, my0, mx1, my1) = table_mask
+        height, width = self.frame_shape(frame)
+        x0, y0, x1, y1 = (0, 0, width, height) if window is None else window
+        bx0, by0, bx1, by1 = max(x0, mx0), max(y0, my0), min(x1, mx1), min(y1, my1)
+        threshold_arr = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        if bx1 > bx0 and by1 > by0:
+            diff = self.preprocessor(self, frame, (bx0, by0, bx1, by1), prev_frame)
+            cv2.bitwise_and(diff, mask[by0:by1, bx0:bx1], dst=threshold_arr[by0 - y0:by1 - y0, bx0 - x0:bx1 - x0])
+        return threshold_arr
+    
+    def two_frame_diff(self, frame, window, prev_frame):
+        '''the chroma difference of frame and prev_frame inside window, the two_frame preprocessor'''
+        if self.input_format == "bgr":
+            return self.preprocess_bgr(frame, window, prev_frame)
+        return self.preprocess_yuv(frame, window, prev_frame)
+    
+    def preprocess_bgr(self, frame, window, prev_frame):
+        '''the Lab chroma difference of two bgr frames inside window'''
+        if not window is None:
+            x0, y0, x1, y1 = window
+            frame = frame[y0:y1, x0:x1]
+            prev_frame = prev_frame[y0:y1, x0:x1]
+        
         lab_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2Lab)
         lab_frame[:, :, 0] = 0.5
         
-        prev_lab = cv2.cvtColor(self.prev_frame, cv2.COLOR_BGR2Lab)
+        prev_lab = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2Lab)
         prev_lab[:, :, 0] = 0.5
         
         frame_diff = cv2.absdiff(lab_frame, prev_lab)
@@ -207,51 +489,247 @@ class Tracker:
         
         return threshold_arr
     
-    def track(self, frame, calc_position=True):
-        '''automatically updates previous frame (be careful with that), also updates sizes, distances, frame_numbers'''
+    def gate_image(self, frame):
+        '''the motion gate's tiny chroma image of a frame, (a, b) for bgr frames and (u, v) for raw yuv'''
+        if self.input_format == "bgr":
+            small = cv2.resize(frame, None, fx=self.gate_scale, fy=self.gate_scale, interpolation=cv2.INTER_AREA)
+            return cv2.cvtColor(small, cv2.COLOR_BGR2Lab)[:, :, 1:].astype(np.int32)
+        scale = 2 * self.gate_scale  # the chroma planes are half resolution already
+        planes = [cv2.resize(plane, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for plane in self.chroma_planes(frame)]
+        return np.dstack(planes).astype(np.int32)
+    
+    def gate_open(self, frame):
+        '''whether frame gets the full search, updates the gate's previous image either way'''
+        with self.metrics.time("motion_gate"):
+            small = self.gate_image(frame)
+            if self.gate_prev is None or self.gate_prev.shape != small.shape:
+                moving = True
+            else:
+                diff = small - self.gate_prev
+                moving = np.any(diff[:, :, 0] ** 2 + diff[:, :, 1] ** 2 > self.gate_threshold)
+            self.gate_prev = small
+        if moving:
+            self.gate_open_until = self.frame_index + self.gate_hold
+        return self.frame_index <= self.gate_open_until
+    
+    def predict_ball_position(self):
+        '''extrapolates the last two detections to the current frame, returns (position, velocity) in screen pixels or None'''
+        detections = self.trajectory.detections
+        frame_numbers = self.trajectory.frame_numbers
+        if len(detections) == 0:
+            return None
+        last = detections[-1, :2].astype(float)
+        if len(detections) < 2:
+            return last, np.zeros(2)
+        velocity = (last - detections[-2, :2]) / (frame_numbers[-1] - frame_numbers[-2])
+        return last + velocity * (self.frame_index - frame_numbers[-1]), velocity
+    
+    def search_window(self, frame_shape):
+        '''returns the (x0, y0, x1, y1) window to search this frame, None means the full frame'''
+        if not self.use_roi or self.roi_misses >= self.roi_max_misses:
+            return None
+        if self.roi_refresh_interval and self.frame_index % self.roi_refresh_interval == 0:
+            return None
+        prediction = self.predict_ball_position()
+        if prediction is None:
+            return None
+        center, velocity = prediction
+        
+        # the diff shows the ball at both its old and new spot so the window has to fit both,
+        # and it keeps growing with every miss in case the ball changed direction
+        ball_size = max(self.trajectory.detections[-1, 2:4])
+        half = ball_size + np.abs(velocity) * (self.roi_misses + 1) + self.roi_margin
+        
+        x0 = int(max(center[0] - half[0], 0))
+        y0 = int(max(center[1] - half[1], 0))
+        x1 = int(min(center[0] + half[0], frame_shape[1]))
+        y1 = int(min(center[1] + half[1], frame_shape[0]))
+        if x1 - x0 < 5 or y1 - y0 < 5:
+            return None  # prediction went off screen
+        return x0, y0, x1, y1
+    
+    def offset_ellipse(self, ellipse, x_offset, y_offset):
+        (cx, cy), axes, angle = ellipse
+        return (cx + x_offset, cy + y_offset), axes, angle
+    
+    def find_ball(self, frame, window=None):
+        '''runs the diff and ellipse search, returns (detection, score, size, threshold_arr).
+        detection is in full frame coordinates and size in full resolution pixels no matter the window or detection_scale'''
+        if self.detection_scale < 1:
+            return self.find_ball_pyramid(frame, window)
+        return self.find_ball_full(frame, window)
+    
+    def find_ball_full(self, frame, window=None):
+        offset = (0, 0) if window is None else window[:2]
+        with self.metrics.time("preprocess"):
+            threshold_arr = self.preprocess(frame, window)
+        detection, score = self.detect_best_ellipse(threshold_arr, offset=offset)
+        
+        size = None
+        if score > self.confidence_threshold:
+            with self.metrics.time("size"):
+                size = self.count_pixels(threshold_arr, detection)  # threshold_arr is in window coordinates
+        if not detection is None:
+            detection = self.offset_ellipse(detection, offset[0], offset[1])
+        return detection, score, size, threshold_arr
+    
+    def find_ball_pyramid(self, frame, window=None):
+        '''finds the ball on a frame downscaled by detection_scale, then diffs and fits it again on a small
+        full resolution crop around it. falls back to the scaled up coarse ellipse if the refinement fails'''
+        scale = self.detection_scale
+        small_window = None if window is None else tuple(int(v * scale) for v in window)
+        offset = (0, 0) if small_window is None else (small_window[0] / scale, small_window[1] / scale)
+        with self.metrics.time("preprocess"):
+            self.frame_small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            if self.prev_frame_small is None or self.prev_frame_small.shape != self.frame_small.shape:
+                self.prev_frame_small = cv2.resize(self.prev_frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            coarse_arr = self.preprocess(self.frame_small, small_window, prev_frame=self.prev_frame_small)
+        coarse, coarse_score = self.detect_best_ellipse(coarse_arr, offset=offset, scale=scale)
+        if coarse is None:
+            return None, coarse_score, None, coarse_arr
+        
+        (cx, cy), (ax1, ax2), angle = coarse
+        center = (cx / scale + offset[0], cy / scale + offset[1])
+        half = max(ax1, ax2) / scale + self.refine_margin
+        refine_window = (int(max(center[0] - half, 0)), int(max(center[1] - half, 0)),
+                         int(min(center[0] + half, frame.shape[1])), int(min(center[1] + half, frame.shape[0])))
+        
+        if refine_window[2] - refine_window[0] >= 5 and refine_window[3] - refine_window[1] >= 5:
+            detection, score, size, threshold_arr = self.find_ball_full(frame, refine_window)
+            if score > self.confidence_threshold:
+                return detection, score, size, threshold_arr
+        
+        size = None
+        if coarse_score > self.confidence_threshold:
+            with self.metrics.time("size"):
+                size = self.count_pixels(coarse_arr, coarse) / scale
+        return (center, (ax1 / scale, ax2 / scale), angle), coarse_score, size, coarse_arr
+    
+    def track(self, frame, calc_position=True, table_position=True):
+        '''automatically updates previous frame (be careful with that), also updates sizes, distances, frame_numbers.
+        with table_position=False the table positions are left as nan for fill_table_positions to do all at once'''
+        with self.metrics.time("track"):
+            return self.track_frame(frame, calc_position, table_position)
+    
+    def track_frame(self, frame, calc_position, table_position):
+        self.new_events = []
+        self.last_smoothed = None
         if self.prev_frame is None:
             self.prev_frame = frame
+            if self.motion_gate:
+                self.gate_prev = self.gate_image(frame)
             return None, 0
-
-        threshold_arr = self.preprocess(frame)
+        self.metrics.count("frames")
         
-        detection, score = self.detect_best_ellipse(threshold_arr)
+        if self.motion_gate and not self.gate_open(frame):
+            # nothing moving, only keep the frame bookkeeping going so frame numbers stay right
+            self.skipped_frames += 1
+            self.metrics.count("skipped_frames")
+            self.roi_misses += 1
+            self.advance_online()
+            self.prev_prev_frame = self.prev_frame
+            self.prev_frame = frame
+            self.prev_frame_small = None  # find_ball_pyramid shrinks prev_frame again when it needs it
+            self.frame_index += 1
+            return None, 0
+
+        frame_shape = self.frame_shape(frame)
+        if self.use_size_map and not self.table_points is None and (self.size_map is None or self.size_map_shape != frame_shape):
+            self.build_size_map(frame_shape)
+        if self.use_table_mask and not self.table_points is None and self.table_mask_shape != tuple(frame_shape):
+            self.build_table_mask(frame_shape)
+
+        window = self.search_window(frame_shape)
+        detection, score, size, threshold_arr = self.find_ball(frame, window)
+        self.last_window = window
         
         if score > self.confidence_threshold:
-            self.recorded_detections.append(detection)
-            size = self.count_pixels(threshold_arr, detection)
+            self.metrics.count("detections")
+            self.roi_misses = 0
             position = detection[0]
-            self.recorded_positions2d.append((position[0], self.image_size[0] - position[1]))
-            self.frame_numbers.append(self.frame_index)
-            self.recorded_sizes.append(size)
-            self.recorded_distances.append(self.calc_distance(size))
-            self.recorded_angles.append(self.calc_angle(position))
-            if not self.table_points is None:
-                self.recorded_table_positions.append(self.calc_table_position(position))
-            if calc_position:
-                # self.recorded_positions.append(self.calc_position(self.recorded_angles[-1][0], self.recorded_angles[-1][1], self.recorded_distances[-1]))
-                self.recorded_positions.append(self.calc_position(self.recorded_distances[-1], position))
+            with self.metrics.time("geometry"):
+                distance = self.calc_distance(size)
+                row = {"size" : size, "distance" : distance, "angle" : self.calc_angle(position),
+                       "position2d" : (position[0], self.image_size[0] - position[1]), "detection" : detection}
+                if not self.table_points is None and table_position:
+                    row["table_position"] = self.calc_table_position(position)
+                if calc_position:
+                    # row["position"] = self.calc_position(row["angle"][0], row["angle"][1], distance)
+                    row["position"] = self.calc_position(distance, position)
+            self.trajectory.append(self.frame_index, **row)
+            self.advance_online(row["position2d"], (size, distance))
             self.last_processed_frame = threshold_arr
+        else:
+            self.roi_misses += 1
+            self.advance_online()
             
+        self.prev_prev_frame = self.prev_frame
         self.prev_frame = frame
+        self.prev_frame_small = self.frame_small
         self.frame_index += 1
         
         return detection, score
 
+    def advance_online(self, position2d=None, size_distance=None):
+        '''moves the live smoother and the online event detector on to this frame, with the detection if there was one.
+        runs on every frame so smoothed values and events still come out when the ball is gone'''
+        if not self.live_smoother is None:
+            if size_distance is None:
+                self.last_smoothed = self.live_smoother.advance(self.frame_index)
+            else:
+                self.last_smoothed = self.live_smoother.push(self.frame_index, size_distance)
+        if not self.event_detector is None:
+            with self.metrics.time("events"):
+                if position2d is None:
+                    self.new_events = self.event_detector.advance(self.frame_index)
+                else:
+                    self.new_events = self.event_detector.push(self.frame_index, *position2d)
+    
     def calc_distance(self, observed_size):
         '''returns distance to ball in feet'''
         distance_m = self.focal_length_px * 0.04 / observed_size
         return distance_m * FEET_PER_METER
     
-    def crop_to_ellipse(self, image, ellipse, padding=2):
+    def crop_around_ellipse(self, image, ellipse, padding=2):
         center = (int(ellipse[0][1]), int(ellipse[0][0]))  # flip axes to align with indexing
         maj_ax = int(ellipse[1][1]) + padding
-        cropped = image[center[0] - maj_ax // 2 : center[0] + maj_ax // 2, center[1] - maj_ax // 2 : center[1] + maj_ax // 2]
+        return image[center[0] - maj_ax // 2 : center[0] + maj_ax // 2, center[1] - maj_ax // 2 : center[1] + maj_ax // 2]
+    
+    def crop_to_ellipse(self, image, ellipse, padding=2):
+        cropped = self.crop_around_ellipse(image, ellipse, padding)
+        if self.size_method == "warp":
+            return self.rotate_warp(cropped, ellipse[2])
         rotated = rotate(cropped, ellipse[2])
         return rotated
     
+    def rotate_warp(self, image, angle):
+        '''scipy.ndimage.rotate(image, angle) (reshape on, same output size and centre) with bilinear cv2.warpAffine instead of splines'''
+        h, w = image.shape[:2]
+        if h == 0 or w == 0:
+            return image  # count_pixels gives 0 for it
+        M = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1.0)
+        out_w = int(abs(M[0, 0]) * w + abs(M[0, 1]) * h + 0.5)
+        out_h = int(abs(M[1, 0]) * w + abs(M[1, 1]) * h + 0.5)
+        M[0, 2] += (out_w - w) / 2
+        M[1, 2] += (out_h - h) / 2
+        return cv2.warpAffine(image, M, (out_w, out_h), flags=cv2.INTER_LINEAR)
+    
+    def size_from_moments(self, image, ellipse):
+        '''the diff's spread along the ellipse's first axis (the direction crop_to_ellipse rotates to horizontal),
+        4 standard deviations is the diameter of a filled disc'''
+        m = cv2.moments(self.crop_around_ellipse(image, ellipse))
+        if m["m00"] == 0:
+            return np.float64(0)  # numpy so calc_distance gives inf like it does for an empty count_pixels
+        c, s = math.cos(math.radians(ellipse[2])), math.sin(math.radians(ellipse[2]))
+        variance = (c * c * m["mu20"] + 2 * c * s * m["mu11"] + s * s * m["mu02"]) / m["m00"]
+        return np.float64(4 * math.sqrt(max(variance, 0)))
+    
     def count_pixels(self, image, ellipse):
+        if self.size_method == "moments":
+            return self.size_from_moments(image, ellipse)
         cropped_image = self.crop_to_ellipse(image, ellipse)
+        if cropped_image.size == 0:
+            return np.int64(0)  # ellipse hanging off the edge of the image
         normalized = cropped_image / np.max(cropped_image)
         density = np.sum(normalized, axis=0)
         num_pixels = np.sum(density > 1)
@@ -334,15 +812,8 @@ class Tracker:
         return new_point
 
     def calc_corners_pos(self):
-        corner_location_pxl = []
         # applies homography to the table corners to get real worls position in mm
-        order = ["TL", "TR", "BR", "BL"]
-        for key in order:
-            pt = self.table_points[key]
-            tbl_cnr_xy = self.transform_point(self.H, pt[0], pt[1])
-            corner_location_pxl.append(np.array([tbl_cnr_xy[0], tbl_cnr_xy[1]]))
-
-        return corner_location_pxl
+        return list(self.calc_table_positions(self.dictionary_to_arranged_list(self.table_points)))
     
     def calc_position(self, angle_x, angle_y, distance):
         dx = math.cos(angle_y) * math.cos(angle_x)
@@ -357,33 +828,22 @@ class Tracker:
         return x, y, z
     
     def calc_position(self, ball_distance_to_camera, ball_pos_pxl):
-        
-        # ball homography applied
-        bxy = self.transform_point(self.H, ball_pos_pxl[0], ball_pos_pxl[1])
-        ball_xy = np.array([bxy[0], bxy[1]])
-
-        # distance of points to ball in mm
-        corners_to_ball_distances = []
-
-        # getting points location and distances using homograhpy
-        for i in self.corner_locations_mm_2d:
-            dist_px = np.linalg.norm(ball_xy - i)
-            corners_to_ball_distances.append(dist_px)
-
-        # ball position calculated and then turned into 3d with height 0 due to homography shift
-        ball_pos_2d = trilaterate_2d_4points(self.corner_locations_mm_2d, corners_to_ball_distances)
-        ball_pos = np.array([ball_pos_2d[0], ball_pos_2d[1], 0.0])
-
-        # line from the camera to the homography ball position
-        line = self.line_through_2points_3d(self.camera_pos, ball_pos)
-
         # returns the real 3d position of the ball in mm relative to top left corner (as of editing)
-        return self.point_along_line_at_distance(line, self.camera_pos, ball_distance_to_camera)
+        return self.calc_positions([ball_distance_to_camera], [ball_pos_pxl])[0]
+    
+    def calc_positions(self, ball_distances, screen_positions):
+        '''3d positions for arrays of distances to the camera and screen positions. the ball's spot on the table
+        (homography) gets trilaterated from the corners and pushed out along the line from the camera to it'''
+        return self.geometry.positions(ball_distances, self.calc_table_positions(screen_positions))
+    
+    def fill_positions(self):
+        '''calc_position for every recorded detection in one go, needs set_distances to have run'''
+        self.trajectory.positions[:] = self.calc_positions(self.trajectory.distances, self.trajectory.detections[:, :2])
         
     def smooth_values(self, sigma=10):
-        full_frames, smooth_sizes = smooth_by_distance(self.frame_numbers, self.recorded_sizes, sigma=sigma)
-        _, smooth_distances = smooth_by_distance(self.frame_numbers, self.recorded_distances, sigma=sigma)
-        return full_frames, smooth_sizes, smooth_distances
+        readings = np.column_stack((self.recorded_sizes, self.recorded_distances))
+        full_frames, smoothed = smooth_by_distance(self.frame_numbers, readings, sigma=sigma)
+        return full_frames, smoothed[:, 0], smoothed[:, 1]
 
     def calc_corner_distances(self):
         if self.corner_distances is None:
@@ -391,26 +851,15 @@ class Tracker:
         return self.corner_distances
     
     def is_net_hit(self, x_pos):
+        if self.table_points is None:
+            return False
         table_x, table_y = self.calc_table_position((x_pos, 500))
         if abs(table_x - 1369.5) < 100:
             return True
     
     def detect_events(self):
-        positions_x = np.array([pos[0] for pos in self.recorded_positions2d])
-        positions_y = np.array([pos[1] for pos in self.recorded_positions2d])
-        positions_x = median_filter(positions_x, size=6)
-        positions_y = median_filter(positions_y, size=4)
-        
-        hit_indices, x_smoothed, hit_properties = find_robust_peaks(positions_x, smooth_window_size=7, prominence=30, distance=5, peak_type='both')
-        hit_indices = list(hit_indices['minima']) + list(hit_indices['maxima'])
-        
-        bounce_indices, y_smoothed, bounce_properties = find_robust_peaks(positions_y, smooth_window_size=5, prominence=5, distance=5, peak_type='min')
-        bounce_indices = [b_index for b_index in bounce_indices if  min([abs(b_index - h_index) for h_index in hit_indices]) > 5] if len(hit_indices) > 0 else bounce_indices
-        is_net = [self.is_net_hit(x_smoothed[index]) for index in hit_indices]
-        net_indices = [index for i, index in enumerate(hit_indices) if is_net[i]]
-        hit_indices = [index for i, index in enumerate(hit_indices) if not is_net[i]]
-        event_data = {"hit_indices" : hit_indices, "bounce_indices" : bounce_indices, "net_indices" : net_indices}
-                
+        event_data = find_events(self.recorded_positions2d[:, 0], self.recorded_positions2d[:, 1], self.is_net_hit)
+        
         event_data['velocities'] = self.calc_velo(event_data)
         # self.calc_velo_simple(event_data)
         return event_data
@@ -423,55 +872,54 @@ class Tracker:
             
 
     def calc_velo(self, dictionary_of_events):
-        hit_indices = dictionary_of_events['hit_indices']
-        positions_x = [pos[0] for pos in self.recorded_positions2d][::-1]
-        positions_y = [pos[1] for pos in self.recorded_positions2d][::-1]
-        hit_indices = hit_indices[::-1]
-
-        frame_numbers_rev = self.frame_numbers[::-1]
-
-        framerate = 120
+        '''speed of the ball from the last time it crossed the net to each bounce, in table mm per second.
+        needs table points, without them (or with no net crossing in the bounce's shot) it's nan.
+
+        only a crossing after the last hit before the bounce counts, and it's found from the table x of the
+        detections alone: for a camera about level with the net a ball in the air still maps to roughly the
+        right x near the net, but its table y doesn't mean anything, and neither does either far off the table.
+        so both detections around a crossing need an x over the table, the time at the net is interpolated
+        along x, and the crossing's y is only used if both are over the table, otherwise the bounce's own y is
+        (the distance along the table). speeds above MAX_BALL_SPEED still can't be real and come out as nan,
+        which gets printed when it happens'''
+        bounces = np.asarray(dictionary_of_events["bounce_indices"], dtype=int)
+        velocities = np.full(len(bounces), np.nan)
+        if self.table_points is None or len(bounces) == 0:
+            return velocities
+        positions = self.recorded_table_positions.astype(float)
+        frame_numbers = self.frame_numbers.astype(float)
 
         net_x = 1369.5
-
-        bounces = dictionary_of_events["bounce_indices"][::-1]
-
-        velocities = []
-
-        # print(hit_indices)
-        # print(positions_x)
-        # print(positions_y)
-        # print(frame_numbers_rev)
-
-        for i in bounces:
-            bounce_x = positions_x[i]
-            bounce_y = positions_y[i]
-            frame_at_bounce = frame_numbers_rev[i]
-
-            for j in range(i + 1, len(positions_y)):
-                # print(i, j, positions_x[j], positions_y[j])
-                # if j not in hit_indices:
-                    if ((positions_x[j] >= 1369.5 and positions_x[j - 1] <= 1369.5) or
-                            (positions_x[j] <= 1369.5 and positions_x[j - 1] >= 1369.5)):
-                        # print("this should be working")
-                        frame_at_net = frame_numbers_rev[j] + 0.5
-
-                        net_y = (positions_y[j] + positions_y[j - 1]) / 2
-
-                        velocity = (((bounce_x - net_x) ** 2 + (bounce_y - net_y) ** 2) ** 0.5) / (
-                            abs(frame_at_bounce - frame_at_net)) * framerate
-                        velocities.append(velocity)
-                        break
-
-                    elif ((positions_x[j] > 1369.5 and positions_x[j - 1] > 1369.5) or
-                          (positions_x[j] < 1369.5 and positions_x[j - 1] < 1369.5)):
-                        pass
-                    else:
-                        print("weird")
-                        velocities.append(None)
-
-        velocities = velocities[::-1]
-        # print(velocities)
+        x, y = positions[:, 0], positions[:, 1]
+        x_valid = (x >= 0) & (x <= TABLE_LENGTH_MM)
+        y_valid = (y >= 0) & (y <= TABLE_WIDTH_MM)
+
+        # crossing k is between detections k - 1 and k, each bounce goes with the last crossing at or before it
+        side = x - net_x
+        crossed = ((side[1:] >= 0) & (side[:-1] <= 0)) | ((side[1:] <= 0) & (side[:-1] >= 0))
+        crossed &= x_valid[1:] & x_valid[:-1] & (side[1:] != side[:-1])
+        crossings = np.flatnonzero(crossed) + 1
+        which = np.searchsorted(crossings, bounces, side="right") - 1
+
+        # the crossing has to be in the same shot as the bounce, after the last hit (or net) before it
+        hits = np.sort(np.concatenate([np.asarray(dictionary_of_events.get(key, []), dtype=int) for key in ("hit_indices", "net_indices")]))
+        last_hit = hits[np.maximum(np.searchsorted(hits, bounces) - 1, 0)] if len(hits) else np.full(len(bounces), -1)
+        last_hit = np.where((len(hits) > 0) & (last_hit < bounces), last_hit, -1)
+
+        found = (which >= 0) & x_valid[bounces] & y_valid[bounces]
+        found[found] &= crossings[which[found]] - 1 >= last_hit[found]
+        k = crossings[which[found]]
+        b = bounces[found]
+
+        along = (net_x - x[k - 1]) / (x[k] - x[k - 1])
+        frame_at_net = frame_numbers[k - 1] + along * (frame_numbers[k] - frame_numbers[k - 1])
+        net_y = np.where(y_valid[k] & y_valid[k - 1], y[k - 1] + along * (y[k] - y[k - 1]), y[b])
+        distance = np.hypot(x[b] - net_x, y[b] - net_y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            velocities[found] = distance / np.abs(frame_numbers[b] - frame_at_net) * self.framerate
+
+        too_fast = velocities > MAX_BALL_SPEED
+        if too_fast.any():
+            print(f"calc_velo: {too_fast.sum()} of {len(bounces)} bounce speeds were over {MAX_BALL_SPEED} mm/s, left out")
+            velocities[too_fast] = np.nan
         return velocities
-
-
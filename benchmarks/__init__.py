@@ -0,0 +1 @@
+# benchmarks for the tracking pipeline, run them from the repo root e.g. python -m benchmarks.ellipse_scoring
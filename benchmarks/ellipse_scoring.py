@@ -0,0 +1,82 @@
+import time
+import cv2
+import numpy as np
+from ball_tracking import Tracker
+
+
+def collect_contours(video_dir, max_frames=200):
+    '''runs the normal frame diff over a video and keeps the contours of every frame'''
+    cap = cv2.VideoCapture(video_dir)
+    ret, frame = cap.read()
+    tracker = Tracker(2000, image_size=frame.shape)
+    tracker.prev_frame = frame
+
+    frames_contours = []
+    while len(frames_contours) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        threshold_arr = tracker.preprocess(frame)
+        contours, _ = cv2.findContours(threshold_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        frames_contours.append(contours)
+        tracker.prev_frame = frame
+    cap.release()
+    return tracker, frames_contours
+
+
+def fit_contours(tracker, contours):
+    '''fits once up front, cv2.fitEllipse isn't deterministic on degenerate contours so both
+    scorers have to be handed the exact same ellipses'''
+    fitted, ellipses = [], []
+    for cont in contours:
+        ellipse = tracker.safe_fit_ellipse(cont)
+        if ellipse is None:
+            continue
+        fitted.append(cont)
+        ellipses.append(ellipse)
+    return fitted, ellipses
+
+
+def score_loop(tracker, contours, ellipses):
+    '''the old per contour, per point scoring'''
+    return np.array([0.5 * tracker.ellipse_area_score(cont, ellipse) + 0.5 * tracker.ellipse_geometric_score(cont, ellipse)
+                     for cont, ellipse in zip(contours, ellipses)])
+
+
+def best_index(scores):
+    # nan scores never win, same as in detect_best_ellipse
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    return np.argmax(scores) if len(scores) > 0 else None
+
+
+def run(video_dir="calibrated1.mp4", max_frames=200):
+    tracker, frames_contours = collect_contours(video_dir, max_frames)
+    frames_fitted = [fit_contours(tracker, contours) for contours in frames_contours]
+    num_contours = sum(len(c) for c in frames_contours)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        start = time.perf_counter()
+        loop_results = [score_loop(tracker, contours, ellipses) for contours, ellipses in frames_fitted]
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch_results = [tracker.score_ellipses(contours, ellipses) for contours, ellipses in frames_fitted]
+        batch_time = time.perf_counter() - start
+
+    same_best = 0
+    max_diff = 0.0
+    for loop_scores, batch_scores in zip(loop_results, batch_results):
+        same_best += best_index(loop_scores) == best_index(batch_scores)
+        finite = np.isfinite(loop_scores)
+        if finite.any():
+            max_diff = max(max_diff, np.max(np.abs(loop_scores[finite] - batch_scores[finite])))
+
+    print(f"{len(frames_contours)} frames, {num_contours} contours (scoring only, ellipse fitting excluded)")
+    print(f"loop:  {loop_time * 1000 :.1f} ms ({loop_time / len(frames_contours) * 1000 :.2f} ms/frame)")
+    print(f"batch: {batch_time * 1000 :.1f} ms ({batch_time / len(frames_contours) * 1000 :.2f} ms/frame)")
+    print(f"speedup: {loop_time / batch_time :.1f}x")
+    print(f"same best ellipse on {same_best}/{len(frames_contours)} frames, max score difference {max_diff :.2e}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,72 @@
+import argparse
+import time
+import numpy as np
+from processing import corner_points_to_dict
+from ball_tracking import Tracker
+from preprocessors import PREPROCESSORS
+from benchmarks.pyramid_detection import TABLE_POINTS, load_frames
+from benchmarks.rally_suite import run_config, ratio
+from benchmarks.synthetic_rally import SyntheticRally
+
+# every preprocessing backend on the same footage: the synthetic rally, where recall is known, and real
+# clips, where the two_frame backend's detections are the reference since there's no ground truth
+
+
+def track_clip(frames, table_points, preprocessor, tracker_kwargs):
+    tracker = Tracker(2000, image_size=frames[0].shape, preprocessor=preprocessor, **tracker_kwargs)
+    tracker.set_table_points(corner_points_to_dict(table_points))
+    start = time.perf_counter()
+    for frame in frames:
+        tracker.track(frame, calc_position=False)
+    return tracker, time.perf_counter() - start
+
+
+def compare_clip(video_dir, table_points, backends, tracker_kwargs, match_px=5):
+    frames = load_frames(video_dir)
+    print(f"\n{video_dir}: {len(frames)} frames of {frames[0].shape[1]}x{frames[0].shape[0]}")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results = {name: track_clip(frames, table_points, name, tracker_kwargs) for name in backends}
+
+    # two_frame's ellipse covers the ball's old and new spot while the other backends only find the new one,
+    # so a detection counts as matched anywhere inside the reference ellipse's long half axis plus match_px
+    reference = results.get("two_frame", next(iter(results.values())))[0]
+    ref_positions = dict(zip(reference.frame_numbers.tolist(), reference.trajectory.detections[:, :2]))
+    ref_tolerances = dict(zip(reference.frame_numbers.tolist(), reference.trajectory.detections[:, 2:4].max(axis=1) / 2 + match_px))
+    ref_events = reference.detect_events()
+    print("backend         fps  preprocess ms  detections  matched  same events")
+    for name, (tracker, elapsed) in results.items():
+        matched = sum(1 for f, position in zip(tracker.frame_numbers.tolist(), tracker.trajectory.detections[:, :2])
+                      if f in ref_positions and np.linalg.norm(position - ref_positions[f]) <= ref_tolerances[f])
+        events = tracker.detect_events()
+        same_events = all(sorted(map(int, events[key])) == sorted(map(int, ref_events[key])) for key in ["hit_indices", "bounce_indices", "net_indices"])
+        print(f"{name :12s} {(len(frames) - 1) / elapsed :6.1f} {tracker.preprocessor.ms_per_frame :14.2f} "
+              f"{len(tracker.frame_numbers) :11d} {ratio(matched, len(ref_positions)) :>8s}  {same_events}")
+
+
+def compare_rally(backends, tracker_kwargs, **rally_kwargs):
+    rally = SyntheticRally(**rally_kwargs)
+    print(f"synthetic rally: {len(rally)} frames of {rally.width}x{rally.height} at {rally.fps} fps, noise {rally.noise}")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results = {name: run_config(rally, dict(tracker_kwargs, preprocessor=name)) for name in backends}
+    print("backend         fps  preprocess ms  recall  precision  median px    hit P/R    bounce P/R")
+    for name, r in results.items():
+        events = [f"{ratio(r[t][0], r[t][1])}/{ratio(r[t][0], r[t][2])}" for t in ("hit", "bounce")]
+        print(f"{name :12s} {r['fps'] :6.1f} {r['preprocess_ms'] :14.2f} {ratio(r['correct'], r['visible']) :>7s} "
+              f"{ratio(r['correct'], r['detections']) :>10s} {r['median_error'] :10.2f} {events[0] :>10s} {events[1] :>13s}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="speed and recall of the preprocessing backends")
+    parser.add_argument("--backends", default=",".join(PREPROCESSORS), help="comma separated, from " + ", ".join(PREPROCESSORS))
+    parser.add_argument("--videos", default="calibrated1.mp4", help="comma separated clips filmed like calibrated1.mp4 (same table corners), empty for none")
+    parser.add_argument("--seconds", type=float, default=4, help="length of the synthetic rally, 0 to skip it")
+    parser.add_argument("--noise", type=float, default=2.0)
+    parser.add_argument("--table-mask", action="store_true", help="run every backend with use_table_mask")
+    args = parser.parse_args()
+
+    backends = args.backends.split(",")
+    tracker_kwargs = dict(use_table_mask=True) if args.table_mask else {}
+    if args.seconds > 0:
+        compare_rally(backends, tracker_kwargs, seconds=args.seconds, noise=args.noise)
+    for video_dir in filter(None, args.videos.split(",")):
+        compare_clip(video_dir, TABLE_POINTS, backends, tracker_kwargs)
@@ -0,0 +1,56 @@
+import time
+import cv2
+import numpy as np
+from processing import corner_points_to_dict
+from ball_tracking import Tracker
+
+TABLE_POINTS = [[240, 390], [1000, 400], [1220, 570], [15, 570]]  # same corners as processing.py uses for this clip
+
+
+def load_frames(video_dir):
+    cap = cv2.VideoCapture(video_dir)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def track_frames(frames, detection_scale):
+    tracker = Tracker(2000, image_size=frames[0].shape, detection_scale=detection_scale)
+    tracker.set_table_points(corner_points_to_dict(TABLE_POINTS))
+    start = time.perf_counter()
+    for frame in frames:
+        tracker.track(frame, calc_position=False)
+    return tracker, time.perf_counter() - start
+
+
+def run(video_dir="calibrated1.mp4", scales=(1.0, 0.5, 0.25)):
+    frames = load_frames(video_dir)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results = [(scale, *track_frames(frames, scale)) for scale in scales]
+
+    # everything is compared against the full resolution run
+    reference = results[0][1]
+    ref_positions = dict(zip(reference.frame_numbers, [d[0] for d in reference.recorded_detections]))
+    ref_sizes = dict(zip(reference.frame_numbers, reference.recorded_sizes))
+    ref_events = reference.detect_events()
+
+    print(f"{len(frames)} frames of {frames[0].shape[1]}x{frames[0].shape[0]}")
+    print("scale    fps   detections  matched  mean px err  90th pct px err  mean size err  same events")
+    for scale, tracker, elapsed in results:
+        common = [(f, d[0], size) for f, d, size in zip(tracker.frame_numbers, tracker.recorded_detections, tracker.recorded_sizes) if f in ref_positions]
+        position_errors = [np.linalg.norm(np.subtract(pos, ref_positions[f])) for f, pos, _ in common]
+        size_errors = [abs(size - ref_sizes[f]) for f, _, size in common]
+        events = tracker.detect_events()
+        same_events = all(sorted(map(int, events[key])) == sorted(map(int, ref_events[key])) for key in ["hit_indices", "bounce_indices", "net_indices"])
+        print(f"{scale :5.2f} {len(frames) / elapsed :6.1f} {len(tracker.frame_numbers) :12d} {len(common) :8d} "
+              f"{np.mean(position_errors) if common else np.nan :12.2f} {np.percentile(position_errors, 90) if common else np.nan :16.2f} "
+              f"{np.mean(size_errors) if common else np.nan :14.2f}  {same_events}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,147 @@
+import argparse
+import resource
+import time
+import numpy as np
+from processing import corner_points_to_dict
+from ball_tracking import Tracker
+from benchmarks.synthetic_rally import SyntheticRally
+
+# tracker settings to compare, anything Tracker takes
+CONFIGS = {
+    "default": {},
+    "roi": dict(use_roi=True),
+    "pyramid": dict(detection_scale=0.5),
+    "warp_size": dict(size_method="warp"),
+    "moments_size": dict(size_method="moments"),
+    "motion_gate": dict(motion_gate=True),
+    "three_frame": dict(preprocessor="three_frame"),
+    "mog2": dict(preprocessor="mog2"),
+}
+
+STAGES = ("preprocess", "detect_best_ellipse", "count_pixels")  # tracker methods that get timed on their own
+
+
+def time_stages(tracker):
+    '''wraps the STAGES methods of this one tracker so the time spent in each adds up in the returned dict'''
+    totals = dict.fromkeys(STAGES, 0.0)
+    for name in STAGES:
+        method = getattr(tracker, name)
+        def timed(*args, method=method, name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                totals[name] += time.perf_counter() - start
+        setattr(tracker, name, timed)
+    return totals
+
+
+def distance_to_motion(detections, previous, current):
+    '''the frame diff has the ball at both its previous and current spot, so a detection is as good as its
+    distance to the line between them (just to the current spot when there was no ball before)'''
+    previous = np.where(np.isnan(previous), current, previous)
+    motion = current - previous
+    length = np.sum(motion ** 2, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        along = np.clip(np.sum((detections - previous) * motion, axis=1) / length, 0, 1)
+    along = np.where(length > 0, along, 0)
+    return np.linalg.norm(detections - (previous + along[:, None] * motion), axis=1)
+
+
+def match_events(predicted, truth, tolerance):
+    '''greedy one to one matching of frame numbers within tolerance, returns (matched, predicted count, true count)'''
+    truth = sorted(truth)
+    used = set()
+    matched = 0
+    for frame in sorted(predicted):
+        candidates = [i for i, t in enumerate(truth) if abs(t - frame) <= tolerance and not i in used]
+        if candidates:
+            used.add(min(candidates, key=lambda i: abs(truth[i] - frame)))
+            matched += 1
+    return matched, len(predicted), len(truth)
+
+
+def run_config(rally, tracker_kwargs):
+    tracker = Tracker(2000, image_size=(rally.height, rally.width, 3), framerate=rally.fps, **tracker_kwargs)
+    tracker.set_table_points(corner_points_to_dict(rally.table_points))
+    stage_times = time_stages(tracker)
+
+    elapsed = 0.0
+    for frame in rally.frames():
+        start = time.perf_counter()
+        tracker.track(frame, calc_position=False)
+        elapsed += time.perf_counter() - start
+
+    start = time.perf_counter()
+    events = tracker.detect_events()
+    event_time = time.perf_counter() - start
+
+    # tracker frame numbers start at the second video frame
+    video_frames = tracker.frame_numbers.astype(int) + 1
+    errors = distance_to_motion(tracker.trajectory.detections[:, :2], rally.screen_positions[video_frames - 1], rally.screen_positions[video_frames])
+    correct = np.sum(errors <= 2 * rally.radii[video_frames])  # nan (no ball on that frame) never counts
+
+    results = {"fps": (len(rally) - 1) / elapsed,
+               "stage_fps": {name: (len(rally) - 1) / total for name, total in stage_times.items() if total > 0},
+               "event_ms": event_time * 1000,
+               "detections": len(video_frames),
+               "correct": int(correct),
+               "visible": int(np.sum(~np.isnan(rally.screen_positions[1:, 0]))),
+               "median_error": float(np.nanmedian(errors)) if len(errors) else np.nan,
+               "trajectory_kb": tracker.trajectory.nbytes / 1024,
+               "skipped": tracker.skipped_frames / (len(rally) - 1),
+               "preprocess_ms": tracker.preprocessor.ms_per_frame}
+
+    tolerance = max(2, round(rally.fps * 0.03))
+    for event_type, key in [("hit", "hit_indices"), ("bounce", "bounce_indices"), ("net", "net_indices")]:
+        predicted = [int(video_frames[index]) for index in events[key]]
+        truth = [event["frame_number"] for event in rally.events if event["type"] == event_type]
+        results[event_type] = match_events(predicted, truth, tolerance)
+    return results
+
+
+def ratio(numerator, denominator):
+    return f"{numerator / denominator :.2f}" if denominator else "-"
+
+
+def run(configs=tuple(CONFIGS), **rally_kwargs):
+    rally = SyntheticRally(**rally_kwargs)
+    counts = {event_type: sum(event["type"] == event_type for event in rally.events) for event_type in ("hit", "bounce", "net")}
+    print(f"{len(rally)} frames of {rally.width}x{rally.height} at {rally.fps} fps, noise {rally.noise}, seed {rally.seed}: "
+          f"{counts['hit']} hits, {counts['bounce']} bounces, {counts['net']} net hits")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        all_results = {name: run_config(rally, CONFIGS[name]) for name in configs}
+
+    print()
+    print("config           fps  preprocess  ellipses     size  events ms  detected  correct  median px  history kb  skipped")
+    for name, r in all_results.items():
+        stage = [f"{r['stage_fps'][s] :.0f}" if s in r["stage_fps"] else "-" for s in STAGES]
+        print(f"{name :12s} {r['fps'] :7.1f} {stage[0] :>11s} {stage[1] :>9s} {stage[2] :>8s} {r['event_ms'] :10.1f} "
+              f"{ratio(r['detections'], r['visible']) :>9s} {ratio(r['correct'], r['visible']) :>8s} {r['median_error'] :10.2f} {r['trajectory_kb'] :11.1f} {r['skipped'] :8.0%}")
+
+    print()
+    print("config        hit P/R    bounce P/R   net P/R")
+    for name, r in all_results.items():
+        cells = [f"{ratio(r[t][0], r[t][1])}/{ratio(r[t][0], r[t][2])}" for t in ("hit", "bounce", "net")]
+        print(f"{name :12s} {cells[0] :>10s} {cells[1] :>12s} {cells[2] :>9s}")
+
+    # ru_maxrss is in KB on linux
+    print(f"\npeak memory (whole process): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 :.0f} MB")
+    return all_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tracker speed and accuracy on a synthetic rally")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=int, default=120)
+    parser.add_argument("--seconds", type=float, default=6)
+    parser.add_argument("--noise", type=float, default=2.0, help="std of the gaussian noise added to every frame")
+    parser.add_argument("--shutter", type=float, default=0.5, help="fraction of the frame interval the ball gets smeared over")
+    parser.add_argument("--net-probability", type=float, default=0.2, help="chance the last shot of a rally goes into the net")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--configs", default=",".join(CONFIGS), help="comma separated, from " + ", ".join(CONFIGS))
+    args = parser.parse_args()
+    run(configs=args.configs.split(","), width=args.width, height=args.height, fps=args.fps,
+        seconds=args.seconds, noise=args.noise, shutter=args.shutter, net_probability=args.net_probability, seed=args.seed)
@@ -0,0 +1,53 @@
+import time
+import numpy as np
+from processing import corner_points_to_dict
+from ball_tracking import Tracker
+from benchmarks.pyramid_detection import TABLE_POINTS, load_frames
+
+METHODS = ("rotate", "warp", "moments")
+
+
+def collect_detections(frames):
+    '''tracks the frames and keeps the diff and ellipse of every accepted detection, which is what count_pixels gets'''
+    tracker = Tracker(2000, image_size=frames[0].shape)
+    tracker.set_table_points(corner_points_to_dict(TABLE_POINTS))
+    detections = []
+    for frame in frames:
+        detection, score = tracker.track(frame, calc_position=False)
+        if score > tracker.confidence_threshold:
+            detections.append((tracker.last_processed_frame, detection))
+    return detections
+
+
+def measure(method, detections, image_size, repeats=5):
+    tracker = Tracker(2000, image_size=image_size, size_method=method)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        sizes = np.array([tracker.count_pixels(threshold_arr, ellipse) for threshold_arr, ellipse in detections], dtype=float)
+    elapsed = (time.perf_counter() - start) / repeats
+    return sizes, elapsed, tracker
+
+
+def run(video_dir="calibrated1.mp4"):
+    frames = load_frames(video_dir)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        detections = collect_detections(frames)
+        results = {method: measure(method, detections, frames[0].shape) for method in METHODS}
+
+    ref_sizes, ref_time, ref_tracker = results["rotate"]
+    with np.errstate(divide="ignore"):
+        ref_distances = ref_tracker.calc_distance(ref_sizes)
+
+    print(f"{len(detections)} detections (size measurement only)")
+    print("method    us/detection  speedup  mean size diff px  median distance err  90th pct distance err")
+    for method in METHODS:
+        sizes, elapsed, tracker = results[method]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distance_errors = np.abs(tracker.calc_distance(sizes) - ref_distances) / ref_distances
+        distance_errors = distance_errors[np.isfinite(distance_errors)]
+        print(f"{method :8s} {elapsed / len(detections) * 1e6 :13.1f} {ref_time / elapsed :8.1f} {np.mean(np.abs(sizes - ref_sizes)) :18.2f} "
+              f"{np.median(distance_errors) * 100 :19.1f}% {np.percentile(distance_errors, 90) * 100 :21.1f}%")
+
+
+if __name__ == "__main__":
+    run()
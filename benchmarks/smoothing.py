@@ -0,0 +1,62 @@
+import time
+import numpy as np
+from smoothing import smooth_by_distance, StreamingSmoother
+
+
+def smooth_by_distance_reference(frame_numbers, readings, sigma=5):
+    '''the original O(frames * readings) version'''
+    frame_numbers = np.array(frame_numbers)
+    readings = np.array(readings)
+
+    full_frames = np.arange(frame_numbers.min(), frame_numbers.max() + 1)
+    smoothed = np.zeros(len(full_frames))
+
+    for j, f in enumerate(full_frames):
+        d = np.abs(frame_numbers - f)
+        weights = np.exp(-(d**2) / (2 * sigma**2))
+        smoothed[j] = np.sum(weights * readings) / np.sum(weights)
+
+    return full_frames, smoothed
+
+
+def fake_match(num_frames, seed=0):
+    '''detections in rallies of 100-400 frames with 50-300 frame gaps between them and a few dropouts'''
+    rng = np.random.default_rng(seed)
+    frames = []
+    f = 0
+    while f < num_frames:
+        rally = rng.integers(100, 400)
+        frames.extend(range(f, min(f + rally, num_frames)))
+        f += rally + rng.integers(50, 300)
+    frames = np.array(frames)
+    frames = frames[rng.random(len(frames)) > 0.2]
+    readings = 20 + 5 * np.sin(frames / 30) + rng.normal(0, 1, len(frames))
+    return frames, readings
+
+
+def run(num_frames=20000, sigma=10):
+    frames, readings = fake_match(num_frames)
+    print(f"{len(frames)} readings over {num_frames} frames, sigma {sigma}")
+
+    start = time.perf_counter()
+    _, reference = smooth_by_distance_reference(frames, readings, sigma)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, fast = smooth_by_distance(frames, readings, sigma)
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    smoother = StreamingSmoother(sigma)
+    streamed = [smoother.push(f, r)[1] for f, r in zip(frames, readings)]
+    streamed = np.concatenate(streamed + [smoother.flush()[1]])
+    streaming_time = time.perf_counter() - start
+
+    print(f"reference: {reference_time :.3f} s")
+    print(f"truncated: {fast_time :.3f} s ({reference_time / fast_time :.0f}x), max abs difference {np.max(np.abs(fast - reference)) :.2e}")
+    print(f"streaming: {streaming_time :.3f} s ({streaming_time / len(frames) * 1e6 :.0f} us per reading), "
+          f"max abs difference {np.max(np.abs(streamed - reference)) :.2e}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,176 @@
+import cv2
+import numpy as np
+from geometry_utils import get_homography, transform_points
+
+TABLE_LENGTH = 2740  # mm, same table get_homography maps to
+TABLE_WIDTH = 1525
+NET_X = 1369.5
+NET_HEIGHT = 152.5
+GRAVITY = 9810       # mm/s^2
+BALL_DIAMETER = 40
+RESTITUTION = 0.85   # of the vertical speed when bouncing on the table
+BALL_COLOR = (0, 140, 255)  # orange, BGR
+
+BACKGROUND = "ping_pong_table.png"
+BACKGROUND_CORNERS = [[55, 395], [795, 298], [1078, 372], [278, 497]]  # table top in the png, TL TR BR BL like processing.py
+
+
+def position_at(segment, t):
+    '''where the ball is t seconds into a flight segment (start time, end time, start position, start velocity)'''
+    dt = t - segment[0]
+    return segment[2] + segment[3] * dt + np.array([0, 0, -0.5 * GRAVITY * dt ** 2])
+
+
+def velocity_at(segment, t):
+    return segment[3] + np.array([0, 0, -GRAVITY * (t - segment[0])])
+
+
+class SyntheticRally:
+    '''
+    A fake rally video with exact ground truth, for benchmarking the tracker.
+
+    The ball flies ballistic arcs in table coordinates (mm, z up): a toss and a hit from just past one
+    end of the table, a bounce on the other half, a hit just past the other end and so on, with the
+    last shot of a rally either missed or (with net_probability) going into the net. There's a short
+    pause without a ball between rallies. The arcs are projected onto ping_pong_table.png (stretched
+    to width x height) through the homography of its table corners, heights going straight up on
+    screen at the local table scale. The shutter is open for shutter of every frame interval and the
+    ball gets smeared over that part of its path, like the motion blur in real footage.
+
+    events are the true hits, bounces and net hits as {"type", "frame_number"} with video frame numbers,
+    screen_positions the ball's true centre on every frame (nan without a ball). frames() renders
+    the video lazily since a long one doesn't fit in memory.
+    '''
+    def __init__(self, width=1280, height=720, fps=120, seconds=10, noise=2.0, shutter=0.5, net_probability=0.2, seed=0,
+                 background=BACKGROUND):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.noise = noise
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        image = cv2.imread(background, cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(background)
+        scale = np.array([width / image.shape[1], height / image.shape[0]])
+        self.background = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        self.table_points = (np.array(BACKGROUND_CORNERS) * scale).tolist()
+        self.H_inv = np.linalg.inv(get_homography(np.array(self.table_points, dtype=np.float32)))  # table mm -> screen
+
+        self.num_frames = int(seconds * fps)
+        self.segments = []
+        self.event_times = []
+        t = 0.3
+        while t < seconds:
+            t = self.plan_rally(t, net_probability) + self.rng.uniform(0.4, 0.8)
+
+        self.positions = self.sample(np.arange(self.num_frames) / fps)
+        self.screen_positions, self.radii = self.project(self.positions)
+        self.shutter_open_positions = self.project(self.sample((np.arange(self.num_frames) - shutter) / fps))[0]
+        self.events = [{"type" : event_type, "frame_number" : int(round(t * fps))} for event_type, t in self.event_times
+                       if round(t * fps) < self.num_frames]
+
+    def __len__(self):
+        return self.num_frames
+
+    def fly(self, t, p, v, duration):
+        self.segments.append((t, t + duration, np.array(p, dtype=float), np.array(v, dtype=float)))
+        return t + duration
+
+    def shot(self, t, p, target, flight_time):
+        '''flight from p that lands on target (z 0) after flight_time, returns the time it lands'''
+        v = (np.array(target, dtype=float) - p) / flight_time
+        v[2] = (0.5 * GRAVITY * flight_time ** 2 - p[2]) / flight_time
+        return self.fly(t, p, v, flight_time)
+
+    def plan_rally(self, t, net_probability):
+        '''adds the flights and events of one rally starting at time t, returns the time the ball is gone'''
+        direction = self.rng.choice([-1, 1])  # +1 means hitting towards the far (x = TABLE_LENGTH) end
+        past_end = self.rng.uniform(50, 250)
+        p = np.array([-past_end if direction > 0 else TABLE_LENGTH + past_end, self.rng.uniform(300, TABLE_WIDTH - 300), self.rng.uniform(200, 300)])
+
+        # the toss, the ball falls onto the racket from its highest point
+        toss = 0.2
+        t = self.fly(t - toss, p + [0, 0, 0.5 * GRAVITY * toss ** 2], (0, 0, 0), toss)
+
+        shots = self.rng.integers(3, 9)
+        for shot in range(shots):
+            self.event_times.append(("hit", t))
+            last = shot == shots - 1
+
+            if last and self.rng.random() < net_probability:
+                # low shot into the net, drops onto the hitter's own half and rolls out
+                height = self.rng.uniform(40, NET_HEIGHT - 20)
+                flight_time = self.rng.uniform(0.2, 0.3)
+                v = (np.array([NET_X, self.rng.uniform(300, TABLE_WIDTH - 300), height]) - p) / flight_time
+                v[2] = (height - p[2] + 0.5 * GRAVITY * flight_time ** 2) / flight_time
+                t = self.fly(t, p, v, flight_time)
+                self.event_times.append(("net", t))
+                p = position_at(self.segments[-1], t)
+                v = velocity_at(self.segments[-1], t) * [-0.15, 0.3, 0]
+                fall = np.sqrt(2 * p[2] / GRAVITY)
+                t = self.fly(t, p, v, fall)
+                self.event_times.append(("bounce", t))
+                p = position_at(self.segments[-1], t)
+                v = velocity_at(self.segments[-1], t) * [1, 1, -0.6]
+                return self.fly(t, p, v, 0.25)
+
+            bounce = [NET_X + direction * self.rng.uniform(400, 1200), self.rng.uniform(200, TABLE_WIDTH - 200), 0]
+            t = self.shot(t, p, bounce, self.rng.uniform(0.3, 0.45))
+            self.event_times.append(("bounce", t))
+            v = velocity_at(self.segments[-1], t) * [1, 1, -RESTITUTION]
+
+            if last:
+                return self.fly(t, bounce, v, 0.3)  # missed, flies off past the end
+            # the other player hits it just past their end of the table
+            end_x = TABLE_LENGTH + self.rng.uniform(50, 250) if direction > 0 else -self.rng.uniform(50, 250)
+            t = self.fly(t, bounce, v, (end_x - bounce[0]) / v[0])
+            p = position_at(self.segments[-1], t)
+            direction = -direction
+        return t
+
+    def sample(self, times):
+        '''ball position at every time, nan where there's no ball'''
+        positions = np.full((len(times), 3), np.nan)
+        starts = np.array([segment[0] for segment in self.segments])
+        which = np.searchsorted(starts, times, side="right") - 1
+        for i, (t, s) in enumerate(zip(times, which)):
+            if s >= 0 and t < self.segments[s][1]:
+                positions[i] = position_at(self.segments[s], t)
+        positions[:, 2] = np.maximum(positions[:, 2], 0)
+        return positions
+
+    def project(self, positions):
+        '''screen centres and radii in pixels for table positions (x, y, height)'''
+        ground = transform_points(self.H_inv, positions[:, :2])
+        # pixels per mm at the spot under the ball, along whichever table axis is less foreshortened
+        dx = transform_points(self.H_inv, positions[:, :2] + [1, 0]) - ground
+        dy = transform_points(self.H_inv, positions[:, :2] + [0, 1]) - ground
+        px_per_mm = np.maximum(np.linalg.norm(dx, axis=1), np.linalg.norm(dy, axis=1))
+        screen = ground - np.column_stack((np.zeros(len(ground)), positions[:, 2] * px_per_mm))
+        return screen, BALL_DIAMETER / 2 * px_per_mm
+
+    def frames(self):
+        '''renders frame after frame (BGR, like cv2.VideoCapture gives)'''
+        cv2.setRNGSeed(self.seed)
+        noise = np.empty(self.background.shape, dtype=np.int16)
+        for start, end, radius in zip(self.shutter_open_positions, self.screen_positions, self.radii):
+            frame = self.background.copy()
+            if not np.isnan(end[0]):
+                if np.isnan(start[0]):
+                    start = end  # the ball only just appeared
+                # a thick line has round ends, so this is the ball swept from start to end. 4 bits of subpixel precision
+                start, end = tuple(np.round(start * 16).astype(int)), tuple(np.round(end * 16).astype(int))
+                cv2.line(frame, start, end, BALL_COLOR, max(1, int(round(radius * 2))), cv2.LINE_AA, shift=4)
+            if self.noise > 0:
+                cv2.randn(noise, 0, self.noise)
+                frame = cv2.add(frame, noise, dtype=cv2.CV_8U)  # saturates instead of wrapping
+            yield frame
+
+    def write(self, path):
+        '''saves the video, e.g. to run processing.process on it'''
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps, (self.width, self.height))
+        for frame in self.frames():
+            writer.write(frame)
+        writer.release()
@@ -0,0 +1,118 @@
+from collections import deque
+import numpy as np
+from scipy.ndimage import median_filter
+from bounce_detection import find_robust_peaks
+
+
+HIT_PEAKS = dict(smooth_window_size=7, prominence=30, distance=5, peak_type='both')      # on screen x
+BOUNCE_PEAKS = dict(smooth_window_size=5, prominence=5, distance=5, peak_type='min')     # on screen y
+MIN_HIT_BOUNCE_GAP = 5  # bounces this close to a hit are really the hit
+
+
+def find_peak_candidates(positions_x, positions_y):
+    '''median filters and smooths the screen positions and finds the hit and bounce peaks in them,
+    returns (hit_indices, bounce_indices, x_smoothed)'''
+    positions_x = median_filter(positions_x, size=6)
+    positions_y = median_filter(positions_y, size=4)
+
+    hit_indices, x_smoothed, hit_properties = find_robust_peaks(positions_x, **HIT_PEAKS)
+    hit_indices = list(hit_indices['minima']) + list(hit_indices['maxima'])
+
+    bounce_indices, y_smoothed, bounce_properties = find_robust_peaks(positions_y, **BOUNCE_PEAKS)
+    return hit_indices, list(bounce_indices), x_smoothed
+
+
+def find_events(positions_x, positions_y, is_net_hit=None):
+    '''the offline event detection over a whole recording, returns {"hit_indices", "bounce_indices", "net_indices"}.
+    is_net_hit takes a smoothed screen x and says whether a hit there was the net'''
+    hit_indices, bounce_indices, x_smoothed = find_peak_candidates(positions_x, positions_y)
+
+    bounce_indices = [b_index for b_index in bounce_indices if min([abs(b_index - h_index) for h_index in hit_indices]) > MIN_HIT_BOUNCE_GAP] if len(hit_indices) > 0 else bounce_indices
+    is_net = [bool(is_net_hit(x_smoothed[index])) if not is_net_hit is None else False for index in hit_indices]
+    net_indices = [index for i, index in enumerate(hit_indices) if is_net[i]]
+    hit_indices = [index for i, index in enumerate(hit_indices) if not is_net[i]]
+    return {"hit_indices" : hit_indices, "bounce_indices" : bounce_indices, "net_indices" : net_indices}
+
+
+class OnlineEventDetector:
+    '''
+    Hit, bounce and net detection that runs while tracking instead of after it.
+
+    It keeps the last window_size detections and reruns find_peak_candidates on just those
+    whenever an event could get decided. lag is in frames: an event is decided once the frame it
+    happened on is lag frames old, so feed it every frame, push for the ones with a detection and
+    advance for the rest (misses, skipped frames). when the ball is gone for lag frames everything
+    before that gets decided without waiting for the next rally. a bounce within MIN_HIT_BOUNCE_GAP
+    detections of a hit is dropped, checked against the hits decided so far and the hit candidates
+    in the window. Every index gets decided exactly once, so nothing is emitted twice.
+
+    Indices count detections since the detector was created, the same as the offline indices
+    into the tracker's recorded arrays. The offline results can differ where a peak's prominence
+    depends on detections that already left the window or that come more than lag frames later.
+    '''
+    def __init__(self, is_net_hit=None, lag=15, window_size=300):
+        self.is_net_hit = is_net_hit
+        self.lag = lag
+        self.xs = deque(maxlen=window_size)
+        self.ys = deque(maxlen=window_size)
+        self.frames = deque(maxlen=window_size)
+        self.count = 0
+        self.ready = 0              # detections whose frame is at least lag frames old
+        self.decided = -1           # every index up to here has been decided
+        self.recent_hits = deque(maxlen=16)
+        self.events = []
+
+    def push(self, frame_number, x, y):
+        '''adds a detection's screen position, returns the events that got decided on its frame'''
+        self.xs.append(x)
+        self.ys.append(y)
+        self.frames.append(frame_number)
+        self.count += 1
+        return self.advance(frame_number)
+
+    def advance(self, frame_number):
+        '''moves on to frame_number, for frames without a detection. returns the events that got decided'''
+        start = self.count - len(self.frames)  # detection index of the oldest one in the window
+        self.ready = max(self.ready, start)
+        while self.ready < self.count and self.frames[self.ready - start] <= frame_number - self.lag:
+            self.ready += 1
+        return self.decide(self.ready - 1)
+
+    def flush(self):
+        '''decides everything that is left, for the end of a recording'''
+        return self.decide(self.count - 1)
+
+    def decide(self, upto):
+        if upto <= self.decided:
+            return []
+        if len(self.xs) <= HIT_PEAKS['smooth_window_size']:
+            return []  # find_robust_peaks can't smooth that little data yet
+
+        start = self.count - len(self.xs)
+        hit_indices, bounce_indices, x_smoothed = find_peak_candidates(np.array(self.xs), np.array(self.ys))
+        hit_indices = sorted(start + index for index in hit_indices)
+
+        new_events = []
+        for index in hit_indices:
+            if self.decided < index <= upto:
+                self.recent_hits.append(index)
+                is_net = not self.is_net_hit is None and bool(self.is_net_hit(x_smoothed[index - start]))
+                new_events.append(self.make_event("net" if is_net else "hit", index))
+
+        for index in sorted(start + index for index in bounce_indices):
+            if self.decided < index <= upto:
+                if all(abs(index - h_index) > MIN_HIT_BOUNCE_GAP for h_index in list(self.recent_hits) + hit_indices):
+                    new_events.append(self.make_event("bounce", index))
+        self.decided = upto
+
+        new_events.sort(key=lambda event: event["index"])
+        self.events.extend(new_events)
+        return new_events
+
+    def make_event(self, event_type, index):
+        return {"type" : event_type, "index" : int(index), "frame_number" : int(self.frames[index - self.count])}
+
+    def event_data(self):
+        '''everything emitted so far in the same layout as Tracker.detect_events'''
+        return {key : [event["index"] for event in self.events if event["type"] == event_type]
+                for key, event_type in [("hit_indices", "hit"), ("bounce_indices", "bounce"), ("net_indices", "net")]}
@@ -173,6 +173,52 @@ def trilaterate_2d_4points(pts, distances):
     return pos
 
 
+class TableGeometry:
+    '''
+    trilaterate_2d_4points and the camera to ball line for a fixed set of table corners, for lots of balls at once.
+
+    The linear system trilaterate_2d_4points builds only depends on the corners, so its pseudo inverse
+    is computed once here and every batch of balls is just a matrix multiply. Gives the same
+    positions as running trilaterate_2d_4points and point_along_line_at_distance per ball.
+    '''
+    def __init__(self, corners_mm_2d, camera_pos):
+        self.corners = np.array(corners_mm_2d, dtype=float)
+        if self.corners.shape != (4, 2):
+            raise ValueError("Expected 4 corners (4x2).")
+        self.camera_pos = np.asarray(camera_pos, dtype=float)
+
+        # same rows as trilaterate_2d_4points, A @ [x, y] = b with b = r1^2 - ri^2 + const_i
+        x1, y1 = self.corners[0]
+        A = 2 * (self.corners[1:] - self.corners[0])
+        self.b_const = np.sum(self.corners[1:] ** 2, axis=1) - x1 ** 2 - y1 ** 2
+        self.A_pinv = np.linalg.pinv(A)  # the least squares solution lstsq gives, A has full rank for a real table
+
+    def trilaterate(self, distances):
+        '''(N, 4) distances to the corners -> (N, 2) positions on the table'''
+        distances = np.asarray(distances, dtype=float).reshape(-1, 4)
+        b = distances[:, :1] ** 2 - distances[:, 1:] ** 2 + self.b_const
+        return b @ self.A_pinv.T
+
+    def positions(self, ball_distances, table_positions):
+        '''3d ball positions in mm, ball_distances (N,) from the camera and table_positions (N, 2)
+        where the ball is on the table seen from the camera'''
+        table_positions = np.asarray(table_positions, dtype=float).reshape(-1, 2)
+        corner_distances = np.linalg.norm(table_positions[:, None, :] - self.corners[None, :, :], axis=2)
+        on_table = np.zeros((len(table_positions), 3))
+        on_table[:, :2] = self.trilaterate(corner_distances)
+
+        direction = on_table - self.camera_pos
+        direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+        return self.camera_pos + np.asarray(ball_distances, dtype=float).reshape(-1, 1) * direction
+
+
+def transform_points(H, points):
+    '''applies the homography H to an (N, 2) array of points in one go, returns (N, 2) floats'''
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    mapped = points @ H[:, :2].T + H[:, 2]
+    return mapped[:, :2] / mapped[:, 2:]
+
+
 def get_homography(src_pts):
     # pixels = 1 mm
     table_width_px = 2740
@@ -0,0 +1,191 @@
+import threading
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.025, 0.035, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)  # seconds
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    '''prometheus style histogram, counts[i] is how many values were <= buckets[i] (and above the bucket
+    before it), the last count is everything above the last bucket'''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        '''estimate of the q quantile, interpolated inside its bucket like prometheus' histogram_quantile does.
+        past the last bucket all it can say is the last bucket'''
+        if self.count == 0:
+            return float("nan")
+        target = q * self.count
+        seen = 0
+        lower = min(0, self.buckets[0])
+        for bound, count in zip(self.buckets, self.counts):
+            if count > 0 and seen + count >= target:
+                return lower + (bound - lower) * (target - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+
+class Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe("stage_seconds", time.perf_counter() - self.start, stage=self.stage)
+        return False
+
+
+class NullTimer:
+    '''what Metrics.time hands out while it's off, does nothing'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    '''
+    Per-stage latency histograms, value histograms (like contours per frame), counters and gauges for the tracker.
+
+    with metrics.time("preprocess"): ... adds the block's duration to the stage_seconds histogram of that
+    stage. While enabled is False every call returns right away (time hands out one shared do-nothing
+    timer), so a tracker without metrics only pays for an attribute lookup and a call per stage.
+    One Metrics can be shared by several trackers and threads.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {}  # (name, stage or None) -> Histogram
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # so worker processes can send their metrics back, locks don't pickle
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def time(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, stage)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, stage=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get((name, stage))
+            if histogram is None:
+                histogram = self.histograms[(name, stage)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def add_gauge(self, name, amount):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def merge(self, other):
+        '''adds another Metrics' histograms and counters to this one (gauges are left alone)'''
+        with self.lock:
+            for key, histogram in other.histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def prometheus_text(self, prefix="pingpong_"):
+        '''everything in the prometheus text exposition format'''
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines += [f"# TYPE {prefix}{name}_total counter", f"{prefix}{name}_total {self.counters[name]}"]
+            for name in sorted(self.gauges):
+                lines += [f"# TYPE {prefix}{name} gauge", f"{prefix}{name} {self.gauges[name]}"]
+            typed = set()
+            for (name, stage), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+                if not name in typed:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    typed.add(name)
+                labels = "" if stage is None else f'stage="{stage}",'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f'{prefix}{name}_bucket{{{labels}le="{le}"}} {cumulative}')
+                labels = "" if stage is None else f'{{stage="{stage}"}}'
+                lines.append(f"{prefix}{name}_sum{labels} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{labels} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        '''a readable table of the stage timings plus the counters, for printing after processing a video'''
+        lines = ["stage              calls    total s   mean ms    p50 ms    p95 ms"]
+        with self.lock:
+            stages = sorted((key for key in self.histograms if key[0] == "stage_seconds"), key=lambda key: -self.histograms[key].sum)
+            for key in stages:
+                histogram = self.histograms[key]
+                lines.append(f"{key[1] :16s} {histogram.count :7d} {histogram.sum :10.2f} {histogram.sum / histogram.count * 1000 :9.2f} "
+                             f"{histogram.quantile(0.5) * 1000 :9.1f} {histogram.quantile(0.95) * 1000 :9.1f}")
+            for (name, stage), histogram in self.histograms.items():
+                if name != "stage_seconds":
+                    lines.append(f"{name}: mean {histogram.sum / max(histogram.count, 1) :.1f}, p50 {histogram.quantile(0.5) :.1f}, p95 {histogram.quantile(0.95) :.1f}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name}: {value}")
+            frames = self.counters.get("frames", 0)
+            if frames:
+                lines.append(f"detection rate: {self.counters.get('detections', 0) / frames :.1%}")
+        return "\n".join(lines)
+
+
+DISABLED = Metrics(enabled=False)  # default for trackers that aren't instrumented
@@ -0,0 +1,154 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import processing
+from result_cache import ResultCache
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,            -- queued, running, done, failed or cancelled
+    video_path TEXT NOT NULL,
+    table_points TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+)
+"""
+
+PROGRESS_INTERVAL = 0.5  # seconds between progress writes, also how quickly a running job notices a cancel
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def connect(db_path):
+    # autocommit so every statement is its own transaction. check_same_thread is off since flask serves
+    # requests from several threads, JobQueue locks around its connection instead
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")  # so polling doesn't block the workers writing progress
+    return connection
+
+
+def run_job(db_path, job_id, video_path, table_points, workers=1, delete_video=False):
+    '''runs in a worker process, tracks the video and stores the events (or the error) in the job's row'''
+    connection = connect(db_path)
+    last_update = 0
+    def progress(done, total):
+        nonlocal last_update
+        now = time.monotonic()
+        if now - last_update < PROGRESS_INTERVAL:
+            return
+        last_update = now
+        connection.execute("UPDATE jobs SET progress = ? WHERE id = ?", (done / max(total, 1), job_id))
+        if connection.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]:
+            raise JobCancelled()
+
+    try:
+        started = connection.execute("UPDATE jobs SET state = 'running', started = ? WHERE id = ? AND state = 'queued' AND cancel_requested = 0",
+                                     (time.time(), job_id)).rowcount
+        if not started:
+            raise JobCancelled()  # cancelled while waiting in the pool
+        events = processing.process(video_path, table_points, workers=workers, progress=progress, output_path=None, cache=ResultCache())
+        connection.execute("UPDATE jobs SET state = 'done', progress = 1, result = ?, finished = ? WHERE id = ?",
+                           (json.dumps(events), time.time(), job_id))
+    except JobCancelled:
+        connection.execute("UPDATE jobs SET state = 'cancelled', finished = ? WHERE id = ? AND state IN ('queued', 'running')", (time.time(), job_id))
+    except Exception as e:
+        connection.execute("UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ?", (repr(e), time.time(), job_id))
+    finally:
+        connection.close()
+        if delete_video and os.path.exists(video_path):
+            os.remove(video_path)
+
+
+class JobQueue:
+    '''
+    Submit/poll video processing, so the api doesn't have to run processing.process inside a request.
+
+    Jobs are rows in a SQLite database and run in a pool of max_workers processes, any more
+    get queued by the pool. Everything about a job (state, progress, result, error) lives in its
+    row, which the worker process updates itself, so status() is just a read. Cancelling a queued
+    job takes it off the queue, a running one stops at its next progress update.
+    '''
+    def __init__(self, db_path="jobs.sqlite", max_workers=2):
+        self.db_path = db_path
+        self.connection = connect(db_path)
+        self.connection.execute(SCHEMA)
+        # jobs a previous server left unfinished won't run anymore. only ones from before this queue started,
+        # another process using the same database may have just queued some of its own
+        self.started = time.time()
+        self.connection.execute("UPDATE jobs SET state = 'failed', error = 'server restarted' WHERE state IN ('queued', 'running') AND created < ?",
+                                (self.started,))
+        # spawn, forking a threaded flask server isn't safe
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.futures = {}
+        self.uploads = set()  # ids of jobs whose video gets deleted when they're over
+        self.lock = threading.Lock()
+
+    def execute(self, *args):
+        with self.lock:
+            return self.connection.execute(*args)
+
+    def submit(self, video_path, table_points, delete_video=False):
+        '''queues a video with its 4 table corners (in order), returns the job id.
+        with delete_video the video gets deleted once the job is over (for uploads)'''
+        job_id = uuid.uuid4().hex
+        self.execute("INSERT INTO jobs (id, state, video_path, table_points, created) VALUES (?, 'queued', ?, ?, ?)",
+                     (job_id, video_path, json.dumps(table_points), time.time()))
+        if delete_video:
+            self.uploads.add(job_id)
+        future = self.executor.submit(run_job, self.db_path, job_id, video_path, table_points, delete_video=delete_video)
+        self.futures[job_id] = future
+        future.add_done_callback(lambda future: self.finished(job_id, future))
+        return job_id
+
+    def finished(self, job_id, future):
+        self.futures.pop(job_id, None)
+        self.uploads.discard(job_id)
+        if not future.cancelled() and not future.exception() is None:
+            # the worker process itself died, run_job didn't get to record anything
+            self.execute("UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ? AND state IN ('queued', 'running')",
+                         (repr(future.exception()), time.time(), job_id))
+
+    def status(self, job_id):
+        '''the job's state and progress (0 to 1) as a dict, None for unknown ids'''
+        row = self.execute("SELECT id, state, progress, error, created, started, finished FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def result(self, job_id):
+        '''the events of a finished job, None if it isn't done'''
+        row = self.execute("SELECT result FROM jobs WHERE id = ? AND state = 'done'", (job_id,)).fetchone()
+        return None if row is None else json.loads(row["result"])
+
+    def cancel(self, job_id):
+        '''returns False if the job is unknown or already over'''
+        requested = self.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND state IN ('queued', 'running')", (job_id,)).rowcount
+        if not requested:
+            return False
+        future = self.futures.get(job_id)
+        delete_video = job_id in self.uploads  # cancelling the future calls finished, which forgets this
+        if not future is None and future.cancel():
+            # never got to a worker, so nothing else will mark it
+            self.execute("UPDATE jobs SET state = 'cancelled', finished = ? WHERE id = ?", (time.time(), job_id))
+            video_path = self.execute("SELECT video_path FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            if delete_video and os.path.exists(video_path):
+                os.remove(video_path)
+        return True
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+        self.connection.close()
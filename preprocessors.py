@@ -0,0 +1,166 @@
+import time
+import cv2
+
+# Backends for Tracker.preprocess, they turn a frame into the uint8 image detect_best_ellipse looks for
+# the ball in (0 where nothing changed, bigger where something did). Tracker(preprocessor=...) takes one
+# of the names in PREPROCESSORS or any Preprocessor instance. the table mask, the search window and the
+# downscaled pass of detection_scale all still happen in Tracker.preprocess around the backend.
+
+
+class Preprocessor:
+    '''
+    Base for the backends. subclasses implement diff(tracker, frame, window, prev_frame) and return the
+    image for the (x0, y0, x1, y1) window (the whole frame for None). calling the backend times diff,
+    frames / seconds / ms_per_frame are its cost so far. a frame counts once even if it gets diffed
+    several times (detection_scale diffs a small frame and then a full resolution crop).
+    params holds the backend's settings (plain values only), the result cache keys on them with the name.
+    backends that can't work on detection_scale's downscaled frame plus full resolution crops set
+    supports_detection_scale to False and the tracker refuses to combine them
+    '''
+    name = None
+    params = {}
+    supports_detection_scale = True
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.frames = 0
+        self.last_frame_index = None
+
+    def __call__(self, tracker, frame, window, prev_frame):
+        start = time.perf_counter()
+        try:
+            return self.diff(tracker, frame, window, prev_frame)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+            if tracker.frame_index != self.last_frame_index:
+                self.frames += 1
+                self.last_frame_index = tracker.frame_index
+
+    def diff(self, tracker, frame, window, prev_frame):
+        raise NotImplementedError
+
+    @property
+    def ms_per_frame(self):
+        return self.seconds / self.frames * 1000 if self.frames else float("nan")
+
+    def reset_cost(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.frames = 0
+        self.last_frame_index = None
+
+
+class TwoFrameDiff(Preprocessor):
+    '''the original: chroma difference to the previous frame (Lab a, b for bgr, U, V for raw yuv).
+    cheapest, but the ball shows up at both its previous and current spot and disappears when it stalls'''
+    name = "two_frame"
+
+    def diff(self, tracker, frame, window, prev_frame):
+        return tracker.two_frame_diff(frame, window, prev_frame)
+
+
+class ThreeFrameDiff(Preprocessor):
+    '''
+    Keeps only what differs from both of the last two frames: the minimum of the diff to the previous frame
+    and the diff to the one before. the ball's previous spot only shows up in the first diff so it drops out,
+    and the result stays on the current frame instead of lagging one behind like the centered version.
+    about twice the cost of two_frame. falls back to two_frame while there's no frame before the previous one
+    '''
+    name = "three_frame"
+
+    def __init__(self):
+        super().__init__()
+        self.resized = (None, None, None)  # (frame index, shape, older frame resized to that shape)
+
+    def older_frame(self, tracker, frame):
+        older = tracker.prev_prev_frame
+        if older is None or older.shape == frame.shape:
+            return older
+        # detection_scale diffs a downscaled frame, shrink the older one the same way (once per frame)
+        index, shape, resized = self.resized
+        if index != tracker.frame_index or shape != frame.shape:
+            resized = cv2.resize(older, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_AREA)
+            self.resized = (tracker.frame_index, frame.shape, resized)
+        return resized
+
+    def diff(self, tracker, frame, window, prev_frame):
+        current = tracker.two_frame_diff(frame, window, prev_frame)
+        older = self.older_frame(tracker, frame)
+        if older is None:
+            return current
+        return cv2.min(current, tracker.two_frame_diff(frame, window, older))
+
+
+class BackgroundSubtractor(Preprocessor):
+    '''
+    OpenCV's MOG2 or KNN background model instead of a frame diff. the ball shows up once, and a stalled ball
+    stays foreground until the model learns it (history frames). the model has to see whole frames so windows
+    and the table mask only crop its output, none of the search window savings apply. it gets updated once per
+    tracked frame, frames the motion gate skips aren't learned. raw yuv is converted to bgr first.
+    scale < 1 runs the model on a downscaled frame and scales the mask back up, use that instead of the
+    tracker's detection_scale (a second full resolution model would only learn from the frames the coarse
+    pass found something on, and cost a whole frame per refine crop)
+    '''
+    supports_detection_scale = False
+
+    def __init__(self, method="mog2", history=500, threshold=None, scale=1.0):
+        super().__init__()
+        if not method in ("mog2", "knn"):
+            raise ValueError("method has to be mog2 or knn")
+        self.name = method
+        self.method = method
+        self.history = history
+        self.threshold = threshold  # varThreshold for mog2, dist2Threshold for knn, None keeps opencv's default
+        self.scale = scale
+        self.params = {"method": method, "history": history, "threshold": threshold, "scale": scale}
+        self.models = {}  # frame shape -> (subtractor, frame index of the last update, foreground mask)
+
+    def make_model(self):
+        if self.method == "mog2":
+            return cv2.createBackgroundSubtractorMOG2(history=self.history, varThreshold=16 if self.threshold is None else self.threshold, detectShadows=False)
+        return cv2.createBackgroundSubtractorKNN(history=self.history, dist2Threshold=400 if self.threshold is None else self.threshold, detectShadows=False)
+
+    def foreground(self, tracker, frame):
+        '''the full frame foreground mask of this frame, the model only learns from the first call per frame'''
+        key = frame.shape
+        model, index, mask = self.models.get(key, (None, None, None))
+        if model is None:
+            model = self.make_model()
+        if index != tracker.frame_index:
+            if tracker.input_format != "bgr":
+                code = cv2.COLOR_YUV2BGR_NV12 if tracker.input_format == "nv12" else cv2.COLOR_YUV2BGR_I420
+                frame = cv2.cvtColor(frame, code)
+            if self.scale < 1:
+                height, width = frame.shape[:2]
+                small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+                mask = cv2.resize(model.apply(small), (width, height), interpolation=cv2.INTER_NEAREST)
+            else:
+                mask = model.apply(frame)
+            self.models[key] = (model, tracker.frame_index, mask)
+        return mask
+
+    def diff(self, tracker, frame, window, prev_frame):
+        mask = self.foreground(tracker, frame)
+        if window is None:
+            return mask
+        x0, y0, x1, y1 = window
+        return mask[y0:y1, x0:x1]
+
+
+PREPROCESSORS = {
+    "two_frame": TwoFrameDiff,
+    "three_frame": ThreeFrameDiff,
+    "mog2": lambda: BackgroundSubtractor("mog2"),
+    "knn": lambda: BackgroundSubtractor("knn"),
+}
+
+
+def make_preprocessor(preprocessor):
+    '''a Preprocessor from one of the PREPROCESSORS names, instances are passed through'''
+    if isinstance(preprocessor, str):
+        if not preprocessor in PREPROCESSORS:
+            raise ValueError("preprocessor has to be one of " + ", ".join(PREPROCESSORS))
+        return PREPROCESSORS[preprocessor]()
+    return preprocessor
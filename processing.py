@@ -1,8 +1,12 @@
 import numpy as np
 from PIL import Image
 from ball_tracking import Tracker
+import instrumentation
+from result_cache import ResultCache
+from results_file import ResultsWriter
 import cv2
 import json
+from concurrent.futures import ProcessPoolExecutor
 
 class Event:
     def __init__(self, type, pos):
@@ -22,34 +26,116 @@ def corner_points_to_dict(corner_points):
 
     return {"TL": top_left, "TR": top_right, "BR": bottom_left, "BL": bottom_right}
 
-def process(video_dir, table_points):
-    
-    cap = cv2.VideoCapture(video_dir)
-    ret, frame = cap.read()
-    print(frame.shape)
-    tracker = Tracker(2000, image_size=frame.shape)
-    table_points = corner_points_to_dict(table_points)
+def make_tracker(image_size, table_points, framerate=120, metrics=None):
+    tracker = Tracker(2000, image_size=image_size, framerate=framerate, metrics=metrics)
     tracker.set_table_points(table_points)
-    
-    i = 0
-    while True:
+    return tracker
+
+def track_chunk(video_dir, image_size, table_points, framerate, start, end, instrument=False):
+    '''tracks video frames [start, end) in its own tracker and returns its trajectory columns and its metrics (None without instrument).
+    frame start - 1 is read first as the previous frame so the diff of the first frame is the same as in a serial run'''
+    cap = cv2.VideoCapture(video_dir)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start - 1)
+    tracker = make_tracker(image_size, table_points, framerate, instrumentation.Metrics() if instrument else None)
+    ret, tracker.prev_frame = cap.read()
+    tracker.frame_index = start - 2  # the serial run never tracks frame 0 and uses frame 1 as its first previous frame
+
+    for i in range(start, end):
         ret, current_frame = cap.read()
-        i += 1
-        print("processing frame", i, end="\r")
-        if i < 0:
-            continue
-        if not ret or i >= 10000:
+        if not ret:
             break
+        tracker.track(current_frame, calc_position=False, table_position=False)
 
-        detection, score = tracker.track(current_frame, calc_position=False)
-        
     cap.release()
+    return tracker.trajectory.as_dict(), tracker.metrics if instrument else None
+
+def track_parallel(tracker, video_dir, table_points, workers, max_frames=10000, progress=None, writer=None):
+    '''splits the video into one frame range per worker and merges the results into tracker in frame order.
+    only gives the same results as a serial run if tracking doesn't carry state between frames (so no use_roi).
+    progress gets called with (frames done, total frames) as the chunks finish. the workers' metrics get added to tracker.metrics
+    and every chunk gets written out with writer (a results_file.ResultsWriter) if there is one'''
+    cap = cv2.VideoCapture(video_dir)
+    num_frames = min(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), max_frames)
+    cap.release()
+
+    bounds = np.linspace(2, num_frames, workers + 1).astype(int)
+    instrument = tracker.metrics.enabled
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # each future keeps the end of its own range, empty ranges get left out
+        futures = [(executor.submit(track_chunk, video_dir, tracker.image_size, table_points, tracker.framerate, start, end, instrument), end)
+                   for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        for future, end in futures:
+            columns, metrics = future.result()
+            tracker.trajectory.extend(columns)
+            if not metrics is None:
+                tracker.metrics.merge(metrics)
+            if not writer is None:
+                writer.sync(tracker)
+            if not progress is None:
+                progress(end, num_frames)
+    tracker.frame_index = num_frames - 2
+
+def process(video_dir, table_points, workers=1, progress=None, output_path="dummy_data.json", metrics=None, cache=None,
+            results_path=None):
+    '''tracks the video and finds its events, returns the net and bounce events (also written to output_path unless it's None).
+    progress gets called with (frames done, total frames) while tracking, it can raise to stop early.
+    give it an instrumentation.Metrics to get the per stage timings, they get printed as a summary at the end.
+    with a result_cache.ResultCache the detections of a video already tracked with the same corners get loaded
+    instead of tracking it again. with results_path the detections get written to a results_file while tracking
+    (so they survive a crash), followed by the events'''
+    
+    cap = cv2.VideoCapture(video_dir)
+    num_frames = min(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 10000)
+    image_size = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+    print(image_size)
+    table_points = corner_points_to_dict(table_points)
+    tracker = make_tracker(image_size, table_points, cap.get(cv2.CAP_PROP_FPS), metrics)
+    writer = None
+    if not results_path is None:
+        writer = ResultsWriter(results_path, metadata={"video": video_dir, "table_points": {corner: np.asarray(point).tolist() for corner, point in table_points.items()},
+                                                       "image_size": image_size, "framerate": tracker.framerate})
     
-    events = tracker.detect_events()
+    cache_key = None if cache is None else cache.key(video_dir, table_points, tracker)
+    cached = not cache_key is None and cache.load(cache_key, tracker)
+    if cached:
+        cap.release()
+        print("loaded", len(tracker.trajectory), "detections from the cache")
+        if not progress is None:
+            progress(num_frames, num_frames)
+    elif workers > 1:
+        cap.release()
+        track_parallel(tracker, video_dir, table_points, workers, progress=progress, writer=writer)
+    else:
+        ret, frame = cap.read()  # frame 0 only ever gets skipped
+        i = 0
+        while True:
+            with tracker.metrics.time("decode"):
+                ret, current_frame = cap.read()
+            i += 1
+            print("processing frame", i, end="\r")
+            if i < 0:
+                continue
+            if not ret or i >= 10000:
+                break
+
+            detection, score = tracker.track(current_frame, calc_position=False, table_position=False)
+            if not writer is None:
+                writer.sync(tracker)
+            if not progress is None:
+                progress(i + 1, num_frames)
+            
+        cap.release()
+    
+    if not cache_key is None and not cached:
+        cache.store(cache_key, tracker)
+    
+    with tracker.metrics.time("detect_events"):
+        tracker.fill_table_positions()  # for the whole video at once instead of every frame
+        events = tracker.detect_events()
     print("events:", events)
     
-    table_positions_x = [pos[0] for pos in tracker.recorded_table_positions]
-    table_positions_y = [pos[1] for pos in tracker.recorded_table_positions]
+    table_positions_x = tracker.recorded_table_positions[:, 0]
+    table_positions_y = tracker.recorded_table_positions[:, 1]
         
     hit_events = [{"frame_number" : int(index), "type" : "hit", "pos" : (int(table_positions_x[index]), int(table_positions_y[index]))} for index in events["hit_indices"]]
     net_events = [{"frame_number" : int(index), "type" : "net", "pos" : (int(table_positions_x[index]), int(table_positions_y[index]))} for index in events["net_indices"]]
@@ -73,8 +159,21 @@ def process(video_dir, table_points):
     
     # print(tracker.H)
     
-    with open("dummy_data.json", "w") as json_file:
-            json.dump(event_points, json_file)
+    if not output_path is None:
+        with open(output_path, "w") as json_file:
+                json.dump(event_points, json_file)
+    
+    if not writer is None:
+        writer.sync(tracker, force=True)
+        all_events = sorted(hit_events + net_events + bounce_events, key=lambda x: x["frame_number"])
+        writer.write_events([dict(event, real_frame_number=int(tracker.frame_numbers[event["frame_number"]])) for event in all_events])
+        writer.close()
+    
+    if not metrics is None:
+        print()
+        print(metrics.summary())
+    
+    return event_points
     
 if __name__ == "__main__":
-    process("calibrated1.mp4", table_points=[[240, 390], [1000, 400], [1220, 570], [15, 570]])
\ No newline at end of file
+    process("calibrated1.mp4", table_points=[[240, 390], [1000, 400], [1220, 570], [15, 570]], cache=ResultCache(), results_path="dummy_data.ppr")
\ No newline at end of file
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+from trajectory_store import COLUMNS
+
+FORMAT_VERSION = 1  # bump when what gets stored changes
+# what the tracked detections depend on, processing.py for how it drives the tracker (the skipped first frame,
+# chunk frame indices, the frame cap, table positions filled in afterwards)
+CODE_FILES = ("ball_tracking.py", "trajectory_store.py", "geometry_utils.py", "preprocessors.py", "processing.py")
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version():
+    '''hash of the tracking code, so results from older code never get reused'''
+    digest = hashlib.sha256(str(FORMAT_VERSION).encode())
+    for name in CODE_FILES:
+        with open(os.path.join(CODE_DIR, name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def tracker_params(tracker):
+    '''the tracker's plain settings (thresholds, flags, image size, framerate...) plus its preprocessor's params,
+    arrays and helper objects are left out'''
+    params = {name: value for name, value in sorted(vars(tracker).items())
+              if value is None or isinstance(value, (bool, int, float, str, tuple)) or isinstance(value, np.number)}
+    params["preprocessor_params"] = dict(getattr(tracker.preprocessor, "params", {}))
+    return params
+
+
+class ResultCache:
+    '''
+    Tracked detections of whole videos on disk, so processing a video again skips decoding and tracking.
+
+    Entries are keyed by a hash of the video's bytes, the table points, the tracker's settings and the
+    tracking code (see key), and hold the trajectory columns as an uncompressed .npz, a few bytes per
+    detection. Once the entries add up to more than max_bytes the least recently used ones get deleted.
+    Video hashes are remembered by path, size and modification time so a hit doesn't have to read the
+    whole video again. Several processes can share a directory, entries are written to a temp file and
+    renamed into place.
+    '''
+    def __init__(self, directory=".result_cache", max_bytes=256 * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.digests_path = os.path.join(directory, "digests.json")
+        self.code_version = code_version()
+
+    def video_digest(self, video_path):
+        stat = os.stat(video_path)
+        stamp = f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        try:
+            with open(self.digests_path) as file:
+                digests = json.load(file)
+        except (OSError, ValueError):
+            digests = {}
+        if not stamp in digests:
+            digests[stamp] = file_digest(video_path)
+            self.write_atomic(self.digests_path, lambda file: file.write(json.dumps(digests).encode()))
+        return digests[stamp]
+
+    def key(self, video_path, table_points, tracker):
+        description = {"video": self.video_digest(video_path),
+                       "table_points": {corner: np.asarray(point, dtype=float).tolist() for corner, point in sorted(table_points.items())},
+                       "tracker": tracker_params(tracker),
+                       "code": self.code_version}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=float).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key, tracker):
+        '''fills tracker's trajectory and frame_index from the cache, returns False on a miss'''
+        try:
+            with np.load(self.path(key)) as entry:
+                columns = {name: entry[name] for name in COLUMNS}
+                frame_index = int(entry["frame_index"])
+        except (OSError, KeyError, ValueError):
+            return False
+        os.utime(self.path(key))  # mtime is the last use, for evict
+        tracker.trajectory.extend(columns)
+        tracker.frame_index = frame_index
+        return True
+
+    def store(self, key, tracker):
+        self.write_atomic(self.path(key), lambda file: np.savez(file, frame_index=tracker.frame_index, **tracker.trajectory.as_dict(copy=False)))
+        self.evict()
+
+    def write_atomic(self, path, write):
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                write(file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def entries(self):
+        '''(last used, bytes, path) of every entry, least recently used first'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # another process just evicted it
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
@@ -0,0 +1,196 @@
+import json
+import os
+import struct
+import zlib
+import numpy as np
+
+from trajectory_store import COLUMNS, TrajectoryStore
+
+# Append only binary results, written while tracking so a crash only loses the last unwritten chunk.
+#
+# layout (little endian):
+#     file header   b"PPRES", version byte, 2 pad bytes, uint32 metadata length, metadata json, zero padding to 8 bytes
+#     chunks        32 byte header (b"CHNK", kind, 3 pad, uint32 rows, uint32 payload bytes, uint32 crc32 of the payload,
+#                   int32 first and last frame number, 4 pad) followed by the payload
+#
+# detection chunks (kind D) are rows of DETECTION_DTYPE, the trajectory store's columns side by side,
+# event chunks (E) rows of EVENT_DTYPE and the end chunk (F, no payload) marks a file that got closed properly.
+# a reader stops at the first chunk that is cut off or fails its crc, everything before it is still good.
+
+MAGIC = b"PPRES"
+VERSION = 1
+FILE_HEADER = struct.Struct("<5sB2xI")
+CHUNK_HEADER = struct.Struct("<4sB3xIIIii4x")
+CHUNK_MAGIC = b"CHNK"
+DETECTIONS, EVENTS, END = b"D", b"E", b"F"
+
+DETECTION_DTYPE = np.dtype([(name, dtype, shape) for name, (dtype, shape) in COLUMNS.items()])
+EVENT_DTYPE = np.dtype([("frame_number", np.int32), ("index", np.int32), ("type", "S8"), ("pos", np.float32, (2,))])
+
+
+class ResultsWriter:
+    '''
+    Writes a results file chunk by chunk. sync(tracker) after every frame writes the detections the
+    tracker recorded since the last sync once there's chunk_rows of them (table positions included,
+    they get computed for the chunk if tracking left them out), close() writes whatever is left and
+    marks the file complete. with fsync every chunk is forced to disk, not just to the os.
+    '''
+    def __init__(self, path, metadata=None, chunk_rows=1024, fsync=False):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.fsync = fsync
+        self.written = 0  # detections written, counted like trajectory rows including the ones a capped store dropped
+        self.file = open(path, "wb")
+        header = json.dumps(metadata or {}, default=float).encode()
+        header += b"\0" * (-(FILE_HEADER.size + len(header)) % 8)
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, len(header)) + header)
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write_chunk(self, kind, rows, first_frame=-1, last_frame=-1):
+        payload = rows.tobytes()
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, kind[0], len(rows), len(payload), zlib.crc32(payload), first_frame, last_frame))
+        self.file.write(payload)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def write_detections(self, columns):
+        '''writes a dict of trajectory columns (like TrajectoryStore.as_dict) as one chunk'''
+        rows = np.empty(len(columns["frame_numbers"]), dtype=DETECTION_DTYPE)
+        if len(rows) == 0:
+            return
+        for name in COLUMNS:
+            rows[name] = columns[name]
+        self.write_chunk(DETECTIONS, rows, int(rows["frame_numbers"][0]), int(rows["frame_numbers"][-1]))
+        self.written += len(rows)
+
+    def sync(self, tracker, force=False):
+        '''writes the tracker's new detections in chunk_rows chunks, with force the last partial one too'''
+        trajectory = tracker.trajectory
+        pending = trajectory.dropped + len(trajectory) - self.written
+        if pending > len(trajectory):
+            raise ValueError("the tracker dropped detections before they got written, sync more often than max_history frames")
+        while pending >= self.chunk_rows or (force and pending > 0):
+            start = len(trajectory) - pending
+            end = start + min(pending, self.chunk_rows)
+            if not tracker.table_points is None and np.isnan(trajectory.table_positions[start:end]).any():
+                trajectory.table_positions[start:end] = tracker.calc_table_positions(trajectory.detections[start:end, :2])
+            self.write_detections({name: trajectory.column(name)[start:end] for name in COLUMNS})
+            pending -= end - start
+
+    def write_events(self, events):
+        '''events as dicts with type, pos and frame_number (the detection index, like processing.process makes them),
+        real_frame_number is used for the frame number if it's there'''
+        rows = np.zeros(len(events), dtype=EVENT_DTYPE)
+        for row, event in zip(rows, events):
+            row["index"] = event["frame_number"]
+            row["frame_number"] = event.get("real_frame_number", event["frame_number"])
+            row["type"] = event["type"].encode()
+            row["pos"] = event["pos"]
+        self.write_chunk(EVENTS, rows)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.write_chunk(END, np.zeros(0, dtype=np.uint8))
+        self.file.close()
+
+
+class ResultsReader:
+    '''
+    Reads a results file through a memory map, so nothing gets loaded until it's asked for.
+    Only the chunk headers are read up front (plus the crc of every payload with verify).
+    complete is False for a file whose writer never got to close it.
+    '''
+    def __init__(self, path, verify=True):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > 0 else np.zeros(0, dtype=np.uint8)
+        if len(self.data) < FILE_HEADER.size:
+            raise ValueError(f"{path} is not a results file")
+        magic, version, header_length = FILE_HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a results file")
+        if version > VERSION:
+            raise ValueError(f"{path} is format version {version}, this reads up to {VERSION}")
+        self.metadata = json.loads(bytes(self.data[FILE_HEADER.size:FILE_HEADER.size + header_length]).rstrip(b"\0") or b"{}")
+
+        self.chunks = []  # (kind, offset of the payload, rows, first frame, last frame)
+        self.complete = False
+        offset = FILE_HEADER.size + header_length
+        while offset + CHUNK_HEADER.size <= len(self.data):
+            magic, kind, rows, length, crc, first_frame, last_frame = CHUNK_HEADER.unpack_from(self.data, offset)
+            start = offset + CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or start + length > len(self.data):
+                break  # cut off while being written
+            if verify and zlib.crc32(self.data[start:start + length]) != crc:
+                break
+            kind = bytes([kind])
+            if kind == END:
+                self.complete = True
+                break
+            self.chunks.append((kind, start, rows, first_frame, last_frame))
+            offset = start + length
+
+        self.detection_chunks = [chunk for chunk in self.chunks if chunk[0] == DETECTIONS]
+        self.row_starts = np.cumsum([0] + [chunk[2] for chunk in self.detection_chunks])
+        self.first_frames = np.array([chunk[3] for chunk in self.detection_chunks], dtype=np.int64)
+
+    def __len__(self):
+        '''number of detections'''
+        return int(self.row_starts[-1])
+
+    def chunk(self, index):
+        '''detection chunk index as a read only structured view into the file, no copy'''
+        _, start, rows, _, _ = self.detection_chunks[index]
+        return self.data[start:start + rows * DETECTION_DTYPE.itemsize].view(DETECTION_DTYPE)
+
+    def detections(self, start=0, stop=None):
+        '''detections start to stop as a structured array (columns like the trajectory store's),
+        only the chunks overlapping the range get touched'''
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if stop <= start:
+            return np.zeros(0, dtype=DETECTION_DTYPE)
+        first = np.searchsorted(self.row_starts, start, side="right") - 1
+        last = np.searchsorted(self.row_starts, stop, side="left")
+        parts = [self.chunk(i) for i in range(first, last)]
+        rows = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        offset = self.row_starts[first]
+        return rows[start - offset:stop - offset]
+
+    def frames(self, first_frame, last_frame):
+        '''detections with first_frame <= frame number < last_frame'''
+        start_chunk = max(np.searchsorted(self.first_frames, first_frame, side="right") - 1, 0)
+        end_chunk = np.searchsorted(self.first_frames, last_frame, side="left")
+        if end_chunk <= start_chunk:
+            return np.zeros(0, dtype=DETECTION_DTYPE)
+        rows = self.detections(self.row_starts[start_chunk], self.row_starts[end_chunk])
+        frame_numbers = rows["frame_numbers"]
+        return rows[(frame_numbers >= first_frame) & (frame_numbers < last_frame)]
+
+    def column(self, name, start=0, stop=None):
+        return self.detections(start, stop)[name]
+
+    def events(self):
+        '''every event written, as dicts like processing.process returns plus the real frame number'''
+        events = []
+        for kind, start, rows, _, _ in self.chunks:
+            if kind != EVENTS:
+                continue
+            for row in self.data[start:start + rows * EVENT_DTYPE.itemsize].view(EVENT_DTYPE):
+                events.append({"frame_number": int(row["index"]), "real_frame_number": int(row["frame_number"]),
+                               "type": row["type"].decode(), "pos": tuple(row["pos"].tolist())})
+        return events
+
+    def trajectory(self):
+        '''all detections in a TrajectoryStore, e.g. for a Tracker to run detect_events on'''
+        rows = self.detections()
+        store = TrajectoryStore(capacity=max(len(rows), 1))
+        store.extend({name: rows[name] for name in COLUMNS})
+        return store
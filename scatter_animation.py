@@ -1,3 +1,8 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")   # headless backend
@@ -15,7 +20,8 @@ def video_scatters(
         current_color="red",
         freeze_sec=1,
         titles=None,
-        is_square: list[bool]=None
+        is_square: list[bool]=None,
+        workers=1
     ):
     """
     Create a video where multiple scatter plots are built point-by-point,
@@ -27,6 +33,8 @@ def video_scatters(
         Each pair becomes one subplot.
     titles : list of strings or None
         Titles for each subplot. If None or too short, missing titles are auto-filled.
+    workers : int
+        Number of processes that each render a part of the frames, the parts get joined at the end.
     """
 
     # Validate inputs
@@ -56,87 +64,150 @@ def video_scatters(
         ys.append(y)
         max_len = max(max_len, len(x))
 
-    # --- Matplotlib figure ---
-    fig = plt.Figure(figsize=figsize)
-    canvas = FigureCanvasAgg(fig)
-    axes = fig.subplots(1, num_plots)
-
-    if num_plots == 1:
-        axes = [axes]
-
-    # Precompute limits per subplot
-    limits = []
-    for i in range(num_plots):
-        x = xs[i]
-        y = ys[i]
-        xmin, xmax = np.min(x), np.max(x)
-        ymin, ymax = np.min(y), np.max(y)
-        xpad = (xmax - xmin) * 0.05 + 1e-9
-        ypad = (ymax - ymin) * 0.05 + 1e-9
-        limits.append((xmin - xpad, xmax + xpad, ymin - ypad, ymax + ypad))
-
-    canvas.draw()
-    w, h = canvas.get_width_height()
-    w, h = int(w), int(h)
-
-    # --- OpenCV writer ---
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    writer = cv2.VideoWriter(out_path, fourcc, fps, (w, h))
-
-    # Convert canvas buffer → OpenCV BGR frame
-    def canvas_to_bgr(canvas):
-        if hasattr(canvas, "tostring_rgb"):
-            arr = np.frombuffer(canvas.tostring_rgb(), dtype=np.uint8)
-            rgb = arr.reshape((h, w, 3))
-        else:
-            arr = np.frombuffer(canvas.tostring_argb(), dtype=np.uint8)
-            arr = arr.reshape((h, w, 4))
-            rgb = arr[:, :, [1, 2, 3]]  # ARGB → RGB
-        return rgb[:, :, ::-1]  # RGB → BGR
+    style = dict(figsize=figsize, point_size=point_size, trail_color=trail_color, current_color=current_color,
+                 titles=titles, is_square=is_square)
+    freeze_frames = int(fps * freeze_sec)
+
+    if workers <= 1 or max_len < 2 * workers:
+        render_segment(xs, ys, style, 0, max_len, out_path, fps, freeze_frames)
+        return out_path
+
+    # every worker renders its own range of frames into its own file, the last one also does the freeze frames.
+    # ffmpeg can join mp4v segments as they are, otherwise they get re-encoded so they're made lossless (FFV1) first
+    bounds = np.linspace(0, max_len, workers + 1).astype(int)
+    fourcc, extension = ("mp4v", os.path.splitext(out_path)[1]) if shutil.which("ffmpeg") else ("FFV1", ".avi")
+    segment_dir = tempfile.mkdtemp(prefix="scatter_segments_")
+    paths = [os.path.join(segment_dir, f"{i}{extension}") for i in range(workers)]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_segment, xs, ys, style, start, end, path, fps, freeze_frames if end == max_len else 0, fourcc)
+                       for start, end, path in zip(bounds[:-1], bounds[1:], paths)]
+            for future in futures:
+                future.result()
+        concat_videos(paths, out_path, fps)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+    return out_path
 
-    last_frame = None
 
-    # --- Animation loop ---
-    for frame_idx in range(max_len):
-        for i, ax in enumerate(axes):
-            ax.clear()
-            xmin, xmax, ymin, ymax = limits[i]
-            ax.set_xlim(xmin, xmax)
-            ax.set_ylim(ymin, ymax)
+class ScatterRenderer:
+    """
+    The figure behind video_scatters, drawn incrementally.
+
+    The axes (limits, grid, titles) get drawn once. Every frame restores the saved image, draws only
+    the trail points that are new since the last frame and saves the image again, then draws the
+    current point on top. So a frame costs the same no matter how long the trail already is.
+    Frames have to be rendered in order but can start anywhere, the first one draws the whole trail before it.
+    """
+    def __init__(self, xs, ys, figsize=(12, 4), point_size=40, trail_color="tab:blue", current_color="red",
+                 titles=None, is_square=None):
+        self.xs = xs
+        self.ys = ys
+        self.fig = plt.Figure(figsize=figsize)
+        self.canvas = FigureCanvasAgg(self.fig)
+        axes = self.fig.subplots(1, len(xs))
+        self.axes = [axes] if len(xs) == 1 else list(axes)
+
+        self.trails = []
+        self.currents = []
+        for i, ax in enumerate(self.axes):
+            x, y = xs[i], ys[i]
+            xmin, xmax = np.min(x), np.max(x)
+            ymin, ymax = np.min(y), np.max(y)
+            xpad = (xmax - xmin) * 0.05 + 1e-9
+            ypad = (ymax - ymin) * 0.05 + 1e-9
+            ax.set_xlim(xmin - xpad, xmax + xpad)
+            ax.set_ylim(ymin - ypad, ymax + ypad)
             ax.grid(True, alpha=0.4)
-            ax.set_title(titles[i])
+            if not titles is None:
+                ax.set_title(titles[i])
             if is_square is not None and is_square[i]:
                 ax.set_aspect('equal')
 
-            x = xs[i]
-            y = ys[i]
-            n = len(x)
-
-            # Trail
-            if frame_idx > 0:
-                upto = min(frame_idx, n)
-                ax.scatter(x[:upto-1], y[:upto-1],
-                           s=point_size, color=trail_color, alpha=0.7)
-
-            # Current point
-            if frame_idx < n:
-                ax.scatter([x[frame_idx]], [y[frame_idx]],
-                           s=point_size * 1.3,
-                           color=current_color,
-                           edgecolors="black")
-
-        canvas.draw()
-        frame_bgr = canvas_to_bgr(canvas)
-        writer.write(frame_bgr)
-        last_frame = frame_bgr
+            # animated artists are left out of canvas.draw(), they only get drawn with draw_artist
+            self.trails.append(ax.scatter([], [], s=point_size, color=trail_color, alpha=0.7, animated=True))
+            self.currents.append(ax.scatter([], [], s=point_size * 1.3, color=current_color, edgecolors="black", animated=True))
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)  # the axes plus every trail point drawn so far
+        self.trail_lengths = [0] * len(xs)
+        w, h = self.canvas.get_width_height()
+        self.size = (int(w), int(h))
+
+    def render(self, frame_idx):
+        """the BGR image of frame frame_idx. the trail is every point before the previous one,
+        the current point is point frame_idx (none once a plot runs out of points)"""
+        self.canvas.restore_region(self.background)
+
+        grew = False
+        for i, ax in enumerate(self.axes):
+            x, y = self.xs[i], self.ys[i]
+            upto = max(min(frame_idx, len(x)) - 1, 0)
+            if upto > self.trail_lengths[i]:
+                self.trails[i].set_offsets(np.column_stack((x[self.trail_lengths[i]:upto], y[self.trail_lengths[i]:upto])))
+                ax.draw_artist(self.trails[i])
+                self.trail_lengths[i] = upto
+                grew = True
+        if grew:
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+        for i, ax in enumerate(self.axes):
+            x, y = self.xs[i], self.ys[i]
+            if frame_idx < len(x):
+                self.currents[i].set_offsets([[x[frame_idx], y[frame_idx]]])
+                ax.draw_artist(self.currents[i])
+
+        return cv2.cvtColor(np.asarray(self.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+    def close(self):
+        plt.close(self.fig)
+
+
+def render_segment(xs, ys, style, start, end, out_path, fps, freeze_frames=0, fourcc="mp4v"):
+    """renders frames [start, end) of the animation into out_path, then repeats the last one freeze_frames times"""
+    renderer = ScatterRenderer(xs, ys, **style)
+    writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*fourcc), fps, renderer.size)
+    last_frame = None
+    for frame_idx in range(start, end):
+        last_frame = renderer.render(frame_idx)
+        writer.write(last_frame)
 
     # --- Freeze last frame ---
     if last_frame is not None:
-        for _ in range(int(fps * freeze_sec)):
+        for _ in range(freeze_frames):
             writer.write(last_frame)
 
     writer.release()
-    plt.close(fig)
+    renderer.close()
+    return out_path
+
+
+def concat_videos(paths, out_path, fps):
+    """joins same sized videos one after the other into an mp4v video. ffmpeg can do it without re-encoding
+    (if the parts are mp4v already), without it every frame gets decoded and written again"""
+    if shutil.which("ffmpeg"):
+        list_path = out_path + ".txt"
+        with open(list_path, "w") as file:
+            file.writelines(f"file '{os.path.abspath(path)}'\n" for path in paths)
+        try:
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", out_path], check=True)
+        finally:
+            os.remove(list_path)
+        return out_path
+
+    writer = None
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if writer is None:
+                writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+        cap.release()
+    if not writer is None:
+        writer.release()
     return out_path
 
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+from ball_tracking import Tracker
+
+
+def make_session_tracker(metrics=None):
+    '''the tracker every new api session starts with, history is capped so an idle session can't grow forever'''
+    return Tracker(focal_length_px=2000, image_size=(4000, 3000), table_points=None, online_events=True, max_history=10000,
+                   metrics=metrics)
+
+
+class Session:
+    '''one client's (or table's) tracker, lock has to be held while using it so frames from
+    concurrent requests don't interleave'''
+    def __init__(self, session_id, tracker):
+        self.session_id = session_id
+        self.tracker = tracker
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    '''
+    Trackers by session id, so one server can follow several tables at once.
+
+    Sessions are kept in least recently used order. Getting a session that doesn't exist yet
+    makes it with make_tracker. Sessions unused for longer than ttl seconds, and the least
+    recently used ones past max_sessions, get dropped (along with their frames and history)
+    whenever a session is looked up. A session that is being used right now is never dropped,
+    so the registry can briefly go over max_sessions under load.
+    '''
+    def __init__(self, make_tracker=make_session_tracker, max_sessions=64, ttl=600):
+        self.make_tracker = make_tracker
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()  # guards the dict itself, each session has its own lock
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def get(self, session_id):
+        '''the session for session_id, made if needed, and marked as just used'''
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, self.make_tracker())
+                self.sessions[session_id] = session
+            else:
+                self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            self.evict(keep=session_id)
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def evict(self, keep=None):
+        '''drops expired sessions and the oldest ones past max_sessions, self.lock has to be held'''
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            too_many = len(self.sessions) > self.max_sessions
+            expired = not self.ttl is None and now - session.last_used > self.ttl
+            if not (too_many or expired):
+                break  # everything after this one was used more recently
+            if session_id == keep or session.lock.locked():
+                continue
+            del self.sessions[session_id]
@@ -0,0 +1,245 @@
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from geometry_utils import get_homography, transform_points
+
+TABLE_LENGTH = 2740  # mm, the table get_homography maps to (x along the table, y across it)
+TABLE_WIDTH = 1525
+NET_X = 1369.5
+
+# BGR
+FLOOR_COLOR = (45, 40, 35)
+TABLE_COLOR = (110, 70, 25)
+LINE_COLOR = (245, 245, 245)
+BALL_COLOR = (0, 140, 255)
+EVENT_COLORS = {"hit": (90, 220, 90), "bounce": (0, 230, 255), "net": (70, 70, 255)}
+
+MAX_TRAIL_GAP = 5  # frames without a detection after which the trail isn't joined up anymore
+
+
+def normalize_events(events):
+    '''events as [{"type", "index"}] sorted by index, from Tracker.detect_events' {"hit_indices", ...} dict
+    or a list of dicts with "index" or (like processing.process makes them) "frame_number" holding the detection index'''
+    if isinstance(events, dict):
+        events = [{"type": key[:-len("_indices")], "index": int(index)}
+                  for key in ("hit_indices", "bounce_indices", "net_indices") for index in events.get(key, [])]
+    else:
+        events = [{"type": event["type"], "index": int(event["index"] if "index" in event else event["frame_number"])} for event in events]
+    return sorted(events, key=lambda event: event["index"])
+
+
+class TrajectoryRenderer:
+    '''
+    Review videos drawn straight into numpy buffers with cv2 instead of going through matplotlib.
+
+    render_top_down draws the table from above with the ball's last trail_frames frames of table positions
+    as a trail that fades out and the events of the last event_frames frames as markers, optionally over
+    the camera frame warped onto the table with H (screen pixels to table mm). render_annotated draws the
+    same trail, events and the detected ellipse onto the camera frame itself. write_video streams either
+    one into a cv2.VideoWriter.
+
+    frame_numbers, table_positions, screen_positions and detections (cx, cy, axis 1, axis 2, angle) are one row
+    per detection like the trajectory store has them. frame_offset gets added to frame_numbers to give video frame
+    numbers, processing.process never tracks frame 0 and diffs from frame 1 on so that's 2 for its results.
+    The buffers are reused, so a returned image is only valid until the next render call. write_video encodes
+    on a second thread while the next frame gets rendered.
+    '''
+    def __init__(self, frame_numbers, table_positions, screen_positions=None, detections=None, events=(), H=None,
+                 width=1920, height=1080, trail_frames=30, event_frames=45, margin_mm=400, frame_offset=0,
+                 overlay_interpolation=cv2.INTER_NEAREST):
+        self.video_frames = np.asarray(frame_numbers, dtype=np.int64) + frame_offset
+        self.table_positions = np.asarray(table_positions, dtype=float)
+        self.screen_positions = None if screen_positions is None else np.asarray(screen_positions, dtype=float)
+        self.detections = None if detections is None else np.asarray(detections, dtype=float)
+        self.events = normalize_events(events)
+        self.event_frames_at = np.array([self.video_frames[event["index"]] for event in self.events], dtype=np.int64)
+        self.H = H
+        self.width = width
+        self.height = height
+        self.trail_frames = trail_frames
+        self.event_frames = event_frames
+        # the camera overlay is half see through, bilinear looks a bit smoother but takes ~4 times as long at 1080p
+        self.overlay_interpolation = overlay_interpolation
+
+        # table mm -> top down pixels, the table plus margin_mm on every side fit into the image and centred
+        scale = min(width / (TABLE_LENGTH + 2 * margin_mm), height / (TABLE_WIDTH + 2 * margin_mm))
+        self.S = np.array([[scale, 0, (width - TABLE_LENGTH * scale) / 2],
+                           [0, scale, (height - TABLE_WIDTH * scale) / 2],
+                           [0, 0, 1]])
+        self.px_per_mm = scale
+        self.top_down_points = transform_points(self.S, self.table_positions) if len(self.table_positions) else np.zeros((0, 2))
+
+        self.background = np.empty((height, width, 3), dtype=np.uint8)
+        self.background[:] = FLOOR_COLOR
+        corners = self.to_pixels(np.array([[0, 0], [TABLE_LENGTH, 0], [TABLE_LENGTH, TABLE_WIDTH], [0, TABLE_WIDTH]]))
+        cv2.fillConvexPoly(self.background, corners, TABLE_COLOR, cv2.LINE_AA, shift=4)
+        self.draw_table_lines(self.background)
+
+        self.canvas = np.empty_like(self.background)
+        self.warped = np.empty_like(self.background)
+        self.annotated = None
+
+    @classmethod
+    def from_tracker(cls, tracker, events=None, **kwargs):
+        '''renderer for everything a tracker recorded, events default to tracker.detect_events()'''
+        trajectory = tracker.trajectory
+        if events is None:
+            events = tracker.detect_events()
+        return cls(trajectory.frame_numbers, trajectory.table_positions, trajectory.detections[:, :2], trajectory.detections,
+                   events, H=None if tracker.table_points is None else tracker.H, **kwargs)
+
+    @classmethod
+    def from_results(cls, reader, **kwargs):
+        '''renderer for a results_file.ResultsReader, H comes from the table points in its metadata'''
+        rows = reader.detections()
+        table_points = reader.metadata.get("table_points")
+        H = None
+        if not table_points is None:
+            H = get_homography(np.array([table_points[corner] for corner in ("TL", "TR", "BR", "BL")], dtype=np.float32))
+        return cls(rows["frame_numbers"], rows["table_positions"], rows["detections"][:, :2], rows["detections"],
+                   reader.events(), H=H, **kwargs)
+
+    def to_pixels(self, table_points):
+        '''table mm to top down pixels, as ints with 4 fractional bits for the cv2 drawing functions' shift'''
+        return np.round(transform_points(self.S, table_points) * 16).astype(np.int32)
+
+    def draw_table_lines(self, image):
+        s = self.px_per_mm
+        thickness = max(1, int(round(20 * s)))  # 2 cm lines
+        corners = self.to_pixels(np.array([[0, 0], [TABLE_LENGTH, 0], [TABLE_LENGTH, TABLE_WIDTH], [0, TABLE_WIDTH]]))
+        cv2.polylines(image, [corners], True, LINE_COLOR, thickness, cv2.LINE_AA, shift=4)
+        middle = self.to_pixels(np.array([[0, TABLE_WIDTH / 2], [TABLE_LENGTH, TABLE_WIDTH / 2]]))
+        cv2.line(image, tuple(middle[0]), tuple(middle[1]), LINE_COLOR, max(1, int(round(3 * s))), cv2.LINE_AA, shift=4)
+        net = self.to_pixels(np.array([[NET_X, -150], [NET_X, TABLE_WIDTH + 150]]))  # the posts stick out 15 cm
+        cv2.line(image, tuple(net[0]), tuple(net[1]), (200, 200, 200), max(2, thickness), cv2.LINE_AA, shift=4)
+
+    def visible(self, frames_at, frame, length):
+        '''index range of the sorted frames_at that are in the last length frames up to frame'''
+        return np.searchsorted(frames_at, frame - length, side="right"), np.searchsorted(frames_at, frame, side="right")
+
+    def draw_trail(self, image, points, frame, fade_color, radius):
+        '''the detections of the last trail_frames frames, older ones closer to fade_color and thinner'''
+        start, end = self.visible(self.video_frames, frame, self.trail_frames)
+        if end == start:
+            return
+        pixels = np.round(points[start:end] * 16).astype(np.int32)
+        ages = (frame - self.video_frames[start:end]) / self.trail_frames
+        ball = np.array(BALL_COLOR, dtype=float)
+        fade = np.array(fade_color, dtype=float)
+        for i in range(end - start):
+            if np.isnan(points[start + i, 0]):
+                continue
+            weight = 1 - ages[i]
+            color = tuple(float(c) for c in fade + (ball - fade) * weight)
+            if i > 0 and self.video_frames[start + i] - self.video_frames[start + i - 1] <= MAX_TRAIL_GAP and not np.isnan(points[start + i - 1, 0]):
+                cv2.line(image, tuple(pixels[i - 1]), tuple(pixels[i]), color, max(1, int(radius * weight)), cv2.LINE_AA, shift=4)
+            cv2.circle(image, tuple(pixels[i]), int(16 * max(radius * weight, 1)), color, -1, cv2.LINE_AA, shift=4)
+
+    def draw_events(self, image, points, frame, radius):
+        '''a ring per event of the last event_frames frames that grows and thins out as it gets older'''
+        start, end = self.visible(self.event_frames_at, frame, self.event_frames)
+        for event, at in zip(self.events[start:end], self.event_frames_at[start:end]):
+            point = points[event["index"]]
+            if np.isnan(point[0]):
+                continue
+            age = (frame - at) / self.event_frames
+            center = tuple(np.round(point * 16).astype(np.int32))
+            thickness = max(1, int(round(radius * 0.6 * (1 - age))))
+            cv2.circle(image, center, int(16 * radius * (1 + 2 * age)), EVENT_COLORS.get(event["type"], LINE_COLOR), thickness, cv2.LINE_AA, shift=4)
+
+    def render_top_down(self, frame, camera_frame=None, overlay_alpha=0.5):
+        '''the top down view at video frame frame, with camera_frame warped underneath if there is one (needs H)'''
+        if camera_frame is None or self.H is None:
+            np.copyto(self.canvas, self.background)
+        else:
+            cv2.warpPerspective(camera_frame, self.S @ self.H, (self.width, self.height), dst=self.warped, flags=self.overlay_interpolation)
+            cv2.addWeighted(self.background, 1 - overlay_alpha, self.warped, overlay_alpha, 0, dst=self.canvas)
+            self.draw_table_lines(self.canvas)  # so they stay crisp over the video
+
+        radius = max(2.0, 20 * self.px_per_mm)  # 40 mm ball
+        self.draw_events(self.canvas, self.top_down_points, frame, radius * 2)
+        self.draw_trail(self.canvas, self.top_down_points, frame, TABLE_COLOR, radius)
+        return self.canvas
+
+    def render_annotated(self, camera_frame, frame):
+        '''camera_frame (video frame frame) with the trail, the events and the ellipse detected on it'''
+        if self.screen_positions is None:
+            raise ValueError("annotating the camera video needs screen_positions")
+        if self.annotated is None or self.annotated.shape != camera_frame.shape:
+            self.annotated = np.empty_like(camera_frame)
+        np.copyto(self.annotated, camera_frame)
+
+        radius = max(2.0, camera_frame.shape[0] / 200)
+        self.draw_events(self.annotated, self.screen_positions, frame, radius * 3)
+        self.draw_trail(self.annotated, self.screen_positions, frame, (0, 0, 0), radius)
+        if not self.detections is None:
+            index = np.searchsorted(self.video_frames, frame)
+            if index < len(self.video_frames) and self.video_frames[index] == frame:
+                (cx, cy, ax1, ax2, angle) = self.detections[index]
+                cv2.ellipse(self.annotated, ((cx, cy), (ax1, ax2), angle), (0, 255, 0), 2, cv2.LINE_AA)
+        return self.annotated
+
+    def write_video(self, out_path, video_path=None, mode="top_down", fps=None, overlay=True, first_frame=None, last_frame=None):
+        '''
+        streams a render of every frame into out_path. mode is "top_down" or "annotated" (which needs video_path).
+        with video_path its frames go underneath the top down view (if overlay and there's an H) and fps defaults
+        to the video's. returns the number of frames written
+        '''
+        if mode not in ("top_down", "annotated"):
+            raise ValueError("mode has to be top_down or annotated")
+        if mode == "annotated" and video_path is None:
+            raise ValueError("the annotated video needs video_path")
+
+        cap = None if video_path is None else cv2.VideoCapture(video_path)
+        if fps is None:
+            fps = cap.get(cv2.CAP_PROP_FPS) if not cap is None else 30
+        if first_frame is None:
+            first_frame = 0 if not cap is None or len(self.video_frames) == 0 else int(self.video_frames[0])
+        if last_frame is None:
+            if not cap is None:
+                last_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            else:
+                last_frame = int(self.video_frames[-1]) + self.trail_frames if len(self.video_frames) else 0
+        if not cap is None and first_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+
+        writer = None
+        written = 0
+        pending = None
+        with ThreadPoolExecutor(max_workers=1) as encoder:  # cv2 lets go of the GIL while encoding
+            for frame in range(first_frame, last_frame):
+                camera_frame = None
+                if not cap is None:
+                    ret, camera_frame = cap.read()
+                    if not ret:
+                        break
+                if mode == "annotated":
+                    image = self.render_annotated(camera_frame, frame)
+                else:
+                    image = self.render_top_down(frame, camera_frame if overlay else None)
+                if writer is None:
+                    writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (image.shape[1], image.shape[0]))
+                if not pending is None:
+                    pending.result()
+                pending = encoder.submit(writer.write, image.copy())  # the next render reuses the buffer
+                written += 1
+            if not pending is None:
+                pending.result()
+
+        if not cap is None:
+            cap.release()
+        if not writer is None:
+            writer.release()
+        return written
+
+
+if __name__ == "__main__":
+    import processing
+    from result_cache import ResultCache
+    from results_file import ResultsReader
+
+    processing.process("calibrated1.mp4", table_points=[[240, 390], [1000, 400], [1220, 570], [15, 570]], output_path=None,
+                       cache=ResultCache(), results_path="dummy_data.ppr")
+    renderer = TrajectoryRenderer.from_results(ResultsReader("dummy_data.ppr"), frame_offset=2)
+    renderer.write_video("top_down.mp4", video_path="calibrated1.mp4")
+    renderer.write_video("annotated.mp4", video_path="calibrated1.mp4", mode="annotated")
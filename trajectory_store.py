@@ -0,0 +1,168 @@
+import numpy as np
+
+
+# name: (dtype, shape of one row). float32 is plenty for pixels and mm and keeps a detection at 68 bytes
+COLUMNS = {
+    "frame_numbers": (np.int32, ()),
+    "sizes": (np.float32, ()),
+    "distances": (np.float32, ()),
+    "angles": (np.float32, (2,)),            # horizontal, vertical in radians
+    "positions": (np.float32, (3,)),         # 3d position, nan unless calc_position was on
+    "positions2d": (np.float32, (2,)),       # screen x, image height - screen y
+    "table_positions": (np.float32, (2,)),   # table mm, nan without table points
+    "detections": (np.float32, (5,)),        # ellipse as cx, cy, axis 1, axis 2, angle
+}
+
+
+class TrajectoryStore:
+    '''
+    Columnar storage for everything the tracker records per detection.
+
+    Every column is a preallocated numpy array that doubles in size when it runs out of room,
+    and the column properties (store.sizes, store.positions2d, ...) are views into it, so analysis
+    code gets plain arrays without copying or rebuilding them from lists.
+
+    With max_length set the store only keeps the most recent max_length rows (for live sessions).
+    It allocates twice that and only moves the kept rows back to the start once the end is reached,
+    so the views stay contiguous and appending stays amortized O(1). dropped counts the rows that
+    fell off the front.
+    '''
+    def __init__(self, capacity=256, max_length=None):
+        self.max_length = max_length
+        if max_length is not None:
+            capacity = 2 * max_length
+        self.arrays = {name: np.empty((capacity, *shape), dtype=dtype) for name, (dtype, shape) in COLUMNS.items()}
+        self.start = 0
+        self.end = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("trajectory index out of range")
+        return TrajectoryRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TrajectoryRow(self, index)
+
+    @property
+    def capacity(self):
+        return len(self.arrays["frame_numbers"])
+
+    @property
+    def nbytes(self):
+        '''bytes used by the rows currently stored'''
+        return sum(self.column(name).nbytes for name in COLUMNS)
+
+    def column(self, name):
+        return self.arrays[name][self.start:self.end]
+
+    def make_room(self, num_rows):
+        if self.end + num_rows <= self.capacity:
+            return
+        if self.max_length is None:
+            new_capacity = max(2 * self.capacity, self.end + num_rows)
+            for name, array in self.arrays.items():
+                grown = np.empty((new_capacity, *array.shape[1:]), dtype=array.dtype)
+                grown[:self.end] = array[:self.end]
+                self.arrays[name] = grown
+            return
+
+        # ring buffer: move the rows still kept back to the front, trim drops whatever is too old afterwards
+        keep = len(self)
+        for array in self.arrays.values():
+            array[:keep] = array[self.start:self.end]
+        self.start = 0
+        self.end = keep
+
+    def trim(self):
+        if self.max_length is not None and len(self) > self.max_length:
+            self.dropped += len(self) - self.max_length
+            self.start = self.end - self.max_length
+
+    def append(self, frame_number, size=np.nan, distance=np.nan, angle=(np.nan, np.nan), position=(np.nan, np.nan, np.nan),
+               position2d=(np.nan, np.nan), table_position=(np.nan, np.nan), detection=None):
+        '''adds one detection, detection is the ((cx, cy), (ax1, ax2), angle) tuple from cv2.fitEllipse'''
+        self.make_room(1)
+        i = self.end
+        self.arrays["frame_numbers"][i] = frame_number
+        self.arrays["sizes"][i] = size
+        self.arrays["distances"][i] = distance
+        self.arrays["angles"][i] = angle
+        self.arrays["positions"][i] = position
+        self.arrays["positions2d"][i] = position2d
+        self.arrays["table_positions"][i] = table_position
+        if detection is None:
+            self.arrays["detections"][i] = np.nan
+        else:
+            (cx, cy), (ax1, ax2), ellipse_angle = detection
+            self.arrays["detections"][i] = (cx, cy, ax1, ax2, ellipse_angle)
+        self.end += 1
+        self.trim()
+
+    def extend(self, columns):
+        '''appends a batch of rows, columns is another store or a dict of arrays like as_dict returns'''
+        if isinstance(columns, TrajectoryStore):
+            columns = columns.as_dict()
+        num_rows = len(columns["frame_numbers"])
+        if self.max_length is not None and num_rows > self.max_length:
+            self.dropped += num_rows - self.max_length
+            columns = {name: values[-self.max_length:] for name, values in columns.items()}
+            num_rows = self.max_length
+        self.make_room(num_rows)
+        for name in COLUMNS:
+            self.arrays[name][self.end:self.end + num_rows] = columns[name]
+        self.end += num_rows
+        self.trim()
+
+    def as_dict(self, copy=True):
+        '''the stored rows as {column name: array}, copies by default so it stays valid after more appends'''
+        return {name: self.column(name).copy() if copy else self.column(name) for name in COLUMNS}
+
+    def clear(self):
+        self.dropped += len(self)
+        self.start = 0
+        self.end = 0
+
+    def ellipse(self, index):
+        '''the detection at index as the tuple cv2 drawing functions expect'''
+        cx, cy, ax1, ax2, angle = self.detections[index].tolist()
+        return (cx, cy), (ax1, ax2), angle
+
+    frame_numbers = property(lambda self: self.column("frame_numbers"))
+    sizes = property(lambda self: self.column("sizes"))
+    distances = property(lambda self: self.column("distances"))
+    angles = property(lambda self: self.column("angles"))
+    positions = property(lambda self: self.column("positions"))
+    positions2d = property(lambda self: self.column("positions2d"))
+    table_positions = property(lambda self: self.column("table_positions"))
+    detections = property(lambda self: self.column("detections"))
+
+
+class TrajectoryRow:
+    '''one detection of a TrajectoryStore, reads straight from the store's arrays'''
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def value(self, name):
+        return self.store.arrays[name][self.store.start + self.index]
+
+    frame_number = property(lambda self: int(self.value("frame_numbers")))
+    size = property(lambda self: float(self.value("sizes")))
+    distance = property(lambda self: float(self.value("distances")))
+    angle = property(lambda self: tuple(self.value("angles").tolist()))
+    position = property(lambda self: tuple(self.value("positions").tolist()))
+    position2d = property(lambda self: tuple(self.value("positions2d").tolist()))
+    table_position = property(lambda self: tuple(self.value("table_positions").tolist()))
+    detection = property(lambda self: self.store.ellipse(self.index))
+
+    def __repr__(self):
+        return f"TrajectoryRow(frame_number={self.frame_number}, position2d={self.position2d}, size={self.size})"